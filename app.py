@@ -1,183 +1,365 @@
+import time
+
+# Inicio de la importación, para medir el arranque (ver create_app)
+_IMPORT_STARTED = time.perf_counter()
+
+import io
 import os
-import zipfile
-from flask import Flask, render_template, request, redirect, url_for, send_file
-import firebase_admin
-from firebase_admin import credentials, firestore
+import logging
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    current_app,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    send_file,
+    jsonify,
+)
 from firebase_utils import (
-    get_all,
+    get_cached,
+    get_cached_many,
     add_record,
+    update_record,
+    delete_record,
+    get_all,
     get_record_by_id,
-    resolve_event_references,
+    get_records_by_ids,
+    build_event_data,
+    get_event_changes,
+    ARCHIVE_COLLECTION,
+    get_archive_cutoff,
+    sync_expired,
+    sync_token,
+    get_collection_version,
+    write_batch,
+    write_events,
+    iter_events_paged,
+    find_conflicts,
+    rebuild_stats,
+    archive_events,
+    start_reference_listeners,
 )
-from datetime import datetime, timedelta
+import threading
+import tempfile
+from datetime import datetime, timedelta, timezone
 
-import io
-import math
-import calendar
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-from reportlab.lib.pagesizes import A4
+import click
+
+from cachetools import LRUCache
 
+from pdf_utils import (
+    DIAS_SEMANA,
+    generate_calendar_pdf,
+    month_range,
+    render_months_parallel,
+)
+from export_utils import XLSX_MIMETYPE, stream_csv, stream_zip, write_xlsx
+from jobs_utils import export_path, get_export, register_exporter, submit_export
+import pdf_cache_utils
+from conflict_utils import describe_conflict
+from import_utils import MAX_IMPORT_ROWS, prepare_import, read_rows
+from recurring_utils import (
+    MAX_MATERIALIZE_DAYS,
+    RECURRING_COLLECTION,
+    may_exist,
+    prepare_materialization,
+)
+from stats_utils import (
+    STATS_COLLECTION,
+    TERRITORY_STATS_COLLECTION,
+    summarize,
+    territory_suggestions,
+)
+from propagation_utils import resume_propagation_jobs, start_propagation
+from storage import backend_generation, on_backend_reset
+from ics_utils import FEED_VARIANTS, format_datetime, write_calendars, write_feed
 
-from ics import Calendar, Event
+import metrics
+from metrics import timed, timed_iter
 from dotenv import load_dotenv
 
 
 load_dotenv()
-app = Flask(__name__)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+# Las rutas se registran en un blueprint; create_app() arma la aplicación.
+# firebase_utils usa el backend elegido con STORAGE_BACKEND (Firestore por
+# defecto, o SQLite local); el cliente se crea una sola vez, en el primer uso
+# (ver storage.py). ReportLab y openpyxl también se importan al usarse.
+bp = Blueprint("main", __name__)
+
+
+@bp.before_app_request
+def resume_background_jobs():
+    # Retoma (una sola vez por proceso) las propagaciones que quedaron a medias
+    resume_propagation_jobs()
+
+
+# Cantidad de territorios sugeridos en el formulario de eventos
+TERRITORY_SUGGESTIONS = 5
+
+
+def get_territory_stats():
+    """Índice de territorios {id: {times_worked, last_worked}} (sin recorrer eventos)."""
+    return {item["id"]: item for item in get_all(TERRITORY_STATS_COLLECTION)}
+
 
-app.secret_key = os.getenv("SECRET_KEY")
+# Campos de un evento que necesita la interfaz
+EVENT_FIELDS = [
+    "title",
+    "start_time",
+    "location_name",
+    "conductor_name",
+    "territory_number",
+]
+EVENTS_PAGE_MAX = 200
+# Páginas de /api/events/changes
+CHANGES_PAGE_MAX = 500
 
-# --- Init Firebase ---
-# if not firebase_admin._apps:
-#    cred = credentials.Certificate("key.json")
-#    firebase_admin.initialize_app(cred)
 
-# db = firestore.client()
-firebase_key_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+def event_snapshot():
+    """Módulo snapshot_utils, importado en el primer uso.
 
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_key_path)
-    firebase_admin.initialize_app(cred)
+    Carga NumPy, que no hace falta para arrancar la app.
+    """
+    import snapshot_utils
 
-db = firestore.client()
+    return snapshot_utils
+
+
+def month_bounds(year, month):
+    """Devuelve el rango [inicio, inicio del mes siguiente) como cadenas ISO."""
+    start = datetime(year, month, 1)
+    if month == 12:
+        end = datetime(year + 1, 1, 1)
+    else:
+        end = datetime(year, month + 1, 1)
+    return start.strftime("%Y-%m-%dT%H:%M"), end.strftime("%Y-%m-%dT%H:%M")
+
+
+def format_start_time(event):
+    """Agrega start_time_formatted a un evento para mostrarlo en la interfaz."""
+    try:
+        start_time_obj = datetime.strptime(event["start_time"], "%Y-%m-%dT%H:%M")
+        event["start_time_formatted"] = start_time_obj.strftime("%b %d, %Y %I:%M %p")
+    except (ValueError, KeyError, TypeError):
+        event["start_time_formatted"] = "N/A"
+    return event
 
 
 # --- Home ---
-@app.route("/")
+@bp.route("/")
 def index():
     return render_template("index.html")
 
 
 # --- Locations ---
-@app.route("/locations")
+@bp.route("/locations")
 def locations():
-    docs = db.collection("locations").stream()
-    data = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+    data = get_cached("locations")
     return render_template("locations.html", locations=data)
 
 
-@app.route("/locations/add", methods=["POST"])
+@bp.route("/locations/add", methods=["POST"])
 def add_location():
     name = request.form.get("name")
     url = request.form.get("url")
-    db.collection("locations").add({"name": name, "url": url})
-    return redirect(url_for("locations"))
+    add_record("locations", {"name": name, "url": url})
+    return redirect(url_for(".locations"))
 
 
-@app.route("/locations/delete/<id>")
+@bp.route("/locations/delete/<id>")
 def delete_location(id):
-    db.collection("locations").document(id).delete()
-    return redirect(url_for("locations"))
+    delete_record("locations", id)
+    return redirect(url_for(".locations"))
 
 
-@app.route("/locations/update/<id>", methods=["POST"])
+@bp.route("/locations/update/<id>", methods=["POST"])
 def update_location(id):
     name = request.form.get("name")
     url = request.form.get("url")
-    db.collection("locations").document(id).update({"name": name, "url": url})
-    return redirect(url_for("locations"))
+    old_data = get_record_by_id("locations", id)
+    update_record("locations", id, {"name": name, "url": url})
+    # Los eventos copian nombre y URL; se actualizan en segundo plano
+    start_propagation("locations", id, old_data.get("name") if old_data else None)
+    return redirect(url_for(".locations"))
 
 
 
 # --- Conductors ---
-@app.route("/conductors")
+@bp.route("/conductors")
 def conductors():
-    docs = db.collection("conductors").stream()
-    data = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+    data = get_cached("conductors")
     return render_template("conductors.html", conductors=data)
 
 
-@app.route("/conductors/add", methods=["POST"])
+@bp.route("/conductors/add", methods=["POST"])
 def add_conductor():
     name = request.form.get("name")
-    db.collection("conductors").add({"name": name})
-    return redirect(url_for("conductors"))
+    add_record("conductors", {"name": name})
+    return redirect(url_for(".conductors"))
 
 
-@app.route("/conductors/delete/<id>")
+@bp.route("/conductors/delete/<id>")
 def delete_conductor(id):
-    db.collection("conductors").document(id).delete()
-    return redirect(url_for("conductors"))
+    delete_record("conductors", id)
+    return redirect(url_for(".conductors"))
 
 
-@app.route("/conductors/edit/<id>")
+@bp.route("/conductors/edit/<id>")
 def edit_conductor(id):
-    doc = db.collection("conductors").document(id).get()
-    if not doc.exists:
-        return redirect(url_for("conductors"))
-    data = {"id": doc.id, **doc.to_dict()}
+    data = get_record_by_id("conductors", id)
+    if data is None:
+        return redirect(url_for(".conductors"))
     return render_template("edit_conductor.html", conductor=data)
 
 
-@app.route("/conductors/update/<id>", methods=["POST"])
+@bp.route("/conductors/update/<id>", methods=["POST"])
 def update_conductor(id):
     name = request.form.get("name")
-    db.collection("conductors").document(id).update({"name": name})
-    return redirect(url_for("conductors"))
+    old_data = get_record_by_id("conductors", id)
+    update_record("conductors", id, {"name": name})
+    # Los eventos copian el nombre; se actualizan en segundo plano
+    start_propagation("conductors", id, old_data.get("name") if old_data else None)
+    return redirect(url_for(".conductors"))
 
 
 
 # --- Territories ---
-@app.route("/territories")
+@bp.route("/territories")
 def territories():
-    docs = db.collection("territories").order_by("number").stream()
-    data = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+    data = get_cached("territories")
     return render_template("territories.html", territories=data)
 
 
 
-@app.route("/territories/add", methods=["POST"])
+@bp.route("/territories/coverage")
+def territory_coverage():
+    """Reporte de cobertura: cada territorio con las veces trabajado y la última fecha."""
+    coverage = territory_suggestions(get_cached("territories"), get_territory_stats())
+    today = datetime.now()
+    for territory in coverage:
+        territory["days_since"] = None
+        if territory["last_worked"]:
+            try:
+                last = datetime.strptime(territory["last_worked"], "%Y-%m-%dT%H:%M")
+                territory["days_since"] = (today - last).days
+            except ValueError:
+                pass
+    return render_template("territory_coverage.html", coverage=coverage)
+
+
+@bp.route("/territories/add", methods=["POST"])
 def add_territory():
     number = request.form.get("number")
-    db.collection("territories").add({"number": int(number)})
-    return redirect(url_for("territories"))
+    add_record("territories", {"number": int(number)})
+    return redirect(url_for(".territories"))
 
 
-@app.route("/territories/delete/<id>")
+@bp.route("/territories/delete/<id>")
 def delete_territory(id):
-    db.collection("territories").document(id).delete()
-    return redirect(url_for("territories"))
+    delete_record("territories", id)
+    return redirect(url_for(".territories"))
 
 
 # --- Events ---
-@app.route("/events")
+@bp.route("/events")
 def events_view():
-    # Use get_all to fetch all documents
-    events = get_all("events")
-
-    # Pre-fetch all related data and store it in dictionaries for fast lookups
-    locations = {loc["id"]: loc for loc in get_all("locations")}
-    conductors = {con["id"]: con for con in get_all("conductors")}
-    territories_list = sorted(
-    get_all("territories"),
-    key=lambda ter: ter["number"],
-    reverse=False  # True = descendente
-)
+    return render_events_page()
 
-    territories = {ter["id"]: ter for ter in territories_list}
 
-    for event in events:
-        try:
-            event["start_time_obj"] = datetime.strptime(
-                event["start_time"], "%Y-%m-%dT%H:%M"
-            )
-            event["start_time_formatted"] = event["start_time_obj"].strftime(
-                "%b %d, %Y %I:%M %p"
-            )
-        except (ValueError, KeyError):
-            event["start_time_formatted"] = "N/A"
+def render_events_page(**context):
+    # Los eventos se cargan por mes desde /api/events; aquí solo van los formularios
+    # Datos de referencia desde la caché en memoria; si falta alguna colección se
+    # leen en paralelo (territorios ya vienen ordenados por número desde la consulta)
+    reference = get_cached_many(["locations", "conductors", "territories"])
+    locations = reference["locations"]
+    conductors = reference["conductors"]
+    territories = reference["territories"]
+
+    # Sugerencias: los territorios trabajados hace más tiempo (una lectura por territorio)
+    suggestions = territory_suggestions(
+        territories, get_territory_stats(), limit=TERRITORY_SUGGESTIONS
+    )
 
     return render_template(
         "events.html",
-        events=events,
-        locations=locations.values(),
-        conductors=conductors.values(),
-        territories=territories.values(),
+        locations=locations,
+        conductors=conductors,
+        territories=territories,
+        suggestions=suggestions,
+        **context,
     )
 
 
-@app.route("/events/add", methods=["POST"])
+@bp.route("/api/events", methods=["GET"])
+def events_api():
+    """Eventos de un mes paginados por start_time con un cursor."""
+    now = datetime.now()
+    year = request.args.get("year", default=now.year, type=int)
+    month = request.args.get("month", default=now.month, type=int)
+    limit = request.args.get("limit", default=100, type=int)
+    cursor = request.args.get("cursor") or None
+
+    if not 1 <= month <= 12:
+        return jsonify({"error": "Mes inválido"}), 400
+    limit = max(1, min(limit, EVENTS_PAGE_MAX))
+
+    start, end = month_bounds(year, month)
+    events, next_cursor = event_snapshot().events_page(
+        start, end, cursor=cursor, limit=limit, fields=EVENT_FIELDS
+    )
+    for event in events:
+        format_start_time(event)
+
+    return jsonify({"events": events, "next_cursor": next_cursor})
+
+
+@bp.route("/api/events/changes", methods=["GET"])
+def events_changes_api():
+    """Eventos cambiados y borrados desde `since` (todos si no se indica).
+
+    La primera página devuelve `since`, el token para la próxima
+    sincronización; se siguen las páginas con `cursor` hasta que sea null.
+    `archived_before` es el corte del archivo: los eventos anteriores se
+    informan como borrados y esos meses se piden a /api/events. Con un
+    `since` más viejo que las marcas de borrado guardadas se devuelven todos
+    los eventos con `reset: true`: el cliente descarta lo que tenía.
+    """
+    since = request.args.get("since") or None
+    reset = bool(since) and sync_expired(since)
+    if reset:
+        since = None
+    cursor = request.args.get("cursor") or None
+    limit = request.args.get("limit", default=CHANGES_PAGE_MAX, type=int)
+    limit = max(1, min(limit, CHANGES_PAGE_MAX))
+
+    token = sync_token()
+    events, deleted, next_cursor = get_event_changes(
+        since, cursor=cursor, limit=limit, fields=EVENT_FIELDS
+    )
+    for event in events:
+        format_start_time(event)
+
+    return jsonify(
+        {
+            "events": events,
+            "deleted": deleted,
+            "next_cursor": next_cursor,
+            "since": token,
+            "archived_before": get_archive_cutoff(),
+            "reset": reset,
+        }
+    )
+
+
+@bp.route("/events/add", methods=["POST"])
 def add_event():
     # Obtener los datos del formulario
     title = request.form["title"]
@@ -191,412 +373,672 @@ def add_event():
     # Separar el string de IDs en una lista
     territory_ids_list = territory_ids_string.split(",")
 
-    # Obtener los datos completos de los documentos relacionados
-    location_data = get_record_by_id("locations", location_id)
-    conductor_data = get_record_by_id("conductors", conductor_id)
-
-    # 🗺️ Procesar los territorios: buscar los números correspondientes a los IDs
-    territory_numbers = []
-    for terr_id in territory_ids_list:
-        if terr_id:  # Evita procesar IDs vacíos
-            territory_data = get_record_by_id("territories", terr_id)
-            if territory_data:
-                territory_numbers.append(str(territory_data.get("number", "N/A")))
+    # Obtener los datos completos de los documentos relacionados en una sola lectura
+    territory_ids_list = [terr_id for terr_id in territory_ids_list if terr_id]
+    records = get_records_by_ids(
+        [("locations", location_id), ("conductors", conductor_id)]
+        + [("territories", terr_id) for terr_id in territory_ids_list]
+    )
+    location_data = records.get(("locations", location_id))
+    conductor_data = records.get(("conductors", conductor_id))
 
-    # 🎯 Unir los números en un solo string
-    territory_numbers_string = ", ".join(territory_numbers)
+    territories_data = [
+        records[("territories", terr_id)]
+        for terr_id in territory_ids_list
+        if ("territories", terr_id) in records
+    ]
 
     # Construir el objeto de datos del evento
-    data = {
-        "title": title,
-        "start_time": start_time,
-        "location_name": location_data.get("name", "N/A") if location_data else "N/A",
-        "url": location_data.get("url", "N/A") if location_data else "N/A",
-        "conductor_name": conductor_data.get("name", "N/A")
-        if conductor_data
-        else "N/A",
-        "territory_number": territory_numbers_string,  # Guarda el string de números
-    }
+    data = build_event_data(
+        title, start_time, location_data, conductor_data, territories_data
+    )
 
-    # Agregar el nuevo registro a la colección 'events'
-    add_record("events", data)
+    # Conductor o ubicación ya ocupados a esa hora: no se guarda
+    conflicts = find_conflicts(data)
+    if conflicts:
+        return (
+            render_events_page(
+                conflicts=[describe_conflict(*conflict) for conflict in conflicts]
+            ),
+            409,
+        )
 
-    return redirect(url_for("events_view"))
+    # Agregar el nuevo registro a la colección 'events' (con sus estadísticas)
+    write_events([("set", "events", None, data)])
 
+    return redirect(url_for(".events_view"))
 
-@app.route("/events/delete/<id>")
-def delete_event(id):
-    db.collection("events").document(id).delete()
-    return redirect(url_for("events_view"))
-
-
-def generate_pdf_from_firestore(year, month, events_data):
-    """Genera un PDF del calendario a partir de los datos de Firestore."""
-
-    # --- Márgenes ---
-    margin_top = 0.7 * inch
-    margin_bottom = 0.5 * inch
-    margin_side = 0.5 * inch
-
-    # --- Configuración general ---
-    cols = 7
-    header_height = 25
-    interlineado = 15
-    espacio_entre_eventos = 8
-    cell_height_deseado = 210
-    cell_width_deseado = 270
-
-    # --- Mes actual ---
-    primer_dia = datetime(year, month, 1).date()
-    ultimo_dia = datetime(year, month, calendar.monthrange(year, month)[1]).date()
-    dias_mes = [
-        primer_dia + timedelta(days=i)
-        for i in range((ultimo_dia - primer_dia).days + 1)
-    ]
-    primer_weekday = primer_dia.weekday()
 
-    # --- Calcular filas necesarias ---
-    total_dias = len(dias_mes) + primer_weekday
-    rows_mes = math.ceil(total_dias / 7)
-    rows = rows_mes + 1
+@bp.route("/events/import", methods=["GET", "POST"])
+def import_events():
+    """Importa eventos desde un CSV o XLSX con escrituras en lote."""
+    if request.method == "GET":
+        return render_template("import.html", max_rows=MAX_IMPORT_ROWS)
+
+    file = request.files.get("file")
+    dry_run = request.form.get("dry_run") == "1"
+    if not file or not file.filename:
+        return render_template(
+            "import.html", max_rows=MAX_IMPORT_ROWS, error="Selecciona un archivo."
+        )
+
+    try:
+        # Nombres -> IDs contra la caché en memoria; sin lecturas por fila
+        reference = get_cached_many(["locations", "conductors", "territories"])
+        result = prepare_import(
+            read_rows(file.filename, file.stream), reference, find_conflicts
+        )
+    except Exception as e:
+        current_app.logger.warning("Error al importar eventos: %s", e)
+        return render_template(
+            "import.html",
+            max_rows=MAX_IMPORT_ROWS,
+            error=f"No se pudo leer el archivo: {e}",
+        )
+
+    imported = 0
+    if result.operations and not dry_run:
+        write_events(result.operations)
+        imported = result.valid_rows
 
-    # --- Calcular tamaño hoja ---
-    width = margin_side * 2 + cell_width_deseado * cols
-    height = (
-        margin_top + margin_bottom + header_height + cell_height_deseado * (rows - 1)
+    return render_template(
+        "import.html",
+        max_rows=MAX_IMPORT_ROWS,
+        result=result,
+        imported=imported,
+        dry_run=dry_run,
     )
 
-    # --- Crear buffer y canvas ---
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=(width, height))
 
-    # --- Función para convertir hex a RGB ---
-    def hex_to_rgb(hex_color):
-        hex_color = hex_color.lstrip("#")
-        return tuple(int(hex_color[i : i + 2], 16) / 255 for i in (0, 2, 4))
+# --- Recurring events ---
+def render_recurring_page(**context):
+    templates = get_all(RECURRING_COLLECTION)
+    reference = get_cached_many(["locations", "conductors", "territories"])
+    locations = {item["id"]: item for item in reference["locations"]}
+    conductors = {item["id"]: item for item in reference["conductors"]}
+    territories = {item["id"]: item for item in reference["territories"]}
+
+    for template in templates:
+        template["weekday_name"] = DIAS_SEMANA[int(template["weekday"])]
+        template["location_name"] = locations.get(template.get("location_id"), {}).get("name", "N/A")
+        template["conductor_name"] = conductors.get(template.get("conductor_id"), {}).get("name", "N/A")
+        template["territory_number"] = ", ".join(
+            str(territories[terr_id].get("number"))
+            for terr_id in template.get("territory_ids", [])
+            if terr_id in territories
+        )
+    templates.sort(key=lambda template: (int(template["weekday"]), template["time"]))
+
+    return render_template(
+        "recurring.html",
+        templates=templates,
+        weekdays=DIAS_SEMANA,
+        locations=reference["locations"],
+        conductors=reference["conductors"],
+        territories=reference["territories"],
+        max_days=MAX_MATERIALIZE_DAYS,
+        **context,
+    )
+
 
-    # --- Colores suaves ---
-    color1 = hex_to_rgb("#B9DBFF")
-    color2 = hex_to_rgb("#CCE5FF")
+@bp.route("/recurring")
+def recurring_view():
+    return render_recurring_page()
 
-    # --- Color de tag de ejemplo ---
-    tag_colors = {
-        "Viloma Cala Cala": hex_to_rgb("#FFDFAF"),
-    }
 
-    # --- Título centrado ---
-    c.setFont("Helvetica-Bold", 28)
-    c.drawCentredString(
-        width / 2,
-        height - margin_top / 2,
-        f"Calendario {primer_dia.strftime('%B %Y').capitalize()}",
+@bp.route("/recurring/add", methods=["POST"])
+def add_recurring():
+    # Un día u hora inválidos romperían la página y la materialización
+    try:
+        weekday = int(request.form["weekday"])
+        time_value = datetime.strptime(request.form["time"], "%H:%M").strftime("%H:%M")
+    except (KeyError, ValueError):
+        weekday, time_value = None, None
+    if weekday is None or not 0 <= weekday < len(DIAS_SEMANA):
+        return render_recurring_page(error="Día u hora inválidos (HH:MM)."), 400
+
+    territory_ids = [terr_id for terr_id in request.form.getlist("territory_ids") if terr_id]
+    add_record(
+        RECURRING_COLLECTION,
+        {
+            "title": request.form["title"],
+            "weekday": weekday,
+            "time": time_value,
+            "location_id": request.form["location_id"],
+            "conductor_id": request.form["conductor_id"],
+            "territory_ids": territory_ids,
+            "materialized_to": None,
+        },
     )
+    return redirect(url_for(".recurring_view"))
 
-    # --- Cabecera de días ---
-    dias_semana = [
-        "Lunes",
-        "Martes",
-        "Miércoles",
-        "Jueves",
-        "Viernes",
-        "Sábado",
-        "Domingo",
-    ]
-    c.setFont("Helvetica-Bold", 18)
-    for i, dia in enumerate(dias_semana):
-        x = margin_side + i * cell_width_deseado
-        y = height - margin_top - header_height
-        c.setFillColorRGB(0.85, 0.85, 0.85)
-        c.rect(x, y, cell_width_deseado, header_height, fill=1, stroke=0)
-        c.setFillColorRGB(0, 0, 0)
-        c.drawCentredString(x + cell_width_deseado / 2, y + 7, dia)
-
-    # --- Leyenda de tags ---
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(
-        margin_side, height - margin_top - header_height - 20, "Leyenda de Tags:"
+
+@bp.route("/recurring/delete/<id>")
+def delete_recurring(id):
+    delete_record(RECURRING_COLLECTION, id)
+    return redirect(url_for(".recurring_view"))
+
+
+@bp.route("/recurring/materialize", methods=["POST"])
+def materialize_recurring():
+    """Crea los eventos de las plantillas en un rango de fechas (idempotente).
+
+    Las ocurrencias hasta `materialized_to` de su plantilla pueden existir: se
+    leen en un solo get_all para restar sus contadores viejos. Es una lectura
+    por ocurrencia al volver a generar un rango ya generado; generar fechas
+    nuevas no lee ningún evento.
+    """
+    try:
+        start_date = datetime.strptime(request.form["start_date"], "%Y-%m-%d").date()
+        end_date = datetime.strptime(request.form["end_date"], "%Y-%m-%d").date()
+    except (KeyError, ValueError):
+        return "Rango de fechas inválido.", 400
+    if end_date < start_date or (end_date - start_date).days > MAX_MATERIALIZE_DAYS:
+        return f"El rango debe ser de hasta {MAX_MATERIALIZE_DAYS} días.", 400
+
+    templates = get_all(RECURRING_COLLECTION)
+    template_id = request.form.get("template_id")
+    if template_id:
+        templates = [template for template in templates if template["id"] == template_id]
+
+    reference = {
+        name: {item["id"]: item for item in items}
+        for name, items in get_cached_many(["locations", "conductors", "territories"]).items()
+    }
+    # Las ocurrencias que chocan con otro evento se omiten y se informan
+    operations, skipped = prepare_materialization(
+        templates, start_date, end_date, reference, find_conflicts
     )
-    y_leyenda = height - margin_top - header_height - 40
-    for tag, color in tag_colors.items():
-        c.setFillColorRGB(*color)
-        c.rect(margin_side, y_leyenda, 50, 15, fill=1, stroke=0)
-        c.setFillColorRGB(0, 0, 0)
-        c.drawString(margin_side + 55, y_leyenda, tag)
-        y_leyenda -= 20
-
-    # --- Grilla de días ---
-    c.setFont("Helvetica", 11)
-    for idx, dia_actual in enumerate(dias_mes):
-        weekday = dia_actual.weekday()
-        row = ((idx + primer_weekday) // cols) + 1
-        col = weekday
-        x = margin_side + col * cell_width_deseado
-        y = height - margin_top - header_height - row * cell_height_deseado
-
-        eventos_dia = [e for e in events_data if e["start_time"].date() == dia_actual]
-
-        # --- Color de fondo: alternancia y tags ---
-        color_fondo = color1 if idx % 2 == 0 else color2
-        for evento in eventos_dia:
-            titulo = evento.get("title", "")
-            for tag, color in tag_colors.items():
-                if tag in titulo:
-                    color_fondo = color
-                    break
-            if color_fondo in tag_colors.values():
-                break
-
-        # Dibujar celda
-        c.setFillColorRGB(*color_fondo)
-        c.rect(x, y, cell_width_deseado, cell_height_deseado, fill=1, stroke=0)
-        c.setFillColorRGB(0, 0, 0)
-        c.rect(x, y, cell_width_deseado, cell_height_deseado)
-
-        # Número del día
-        c.setFont("Helvetica-Bold", 18)
-        c.drawString(x + 2, y + cell_height_deseado - 16, str(dia_actual.day))
-        c.setFont("Helvetica", 11)
-
-        # --- Dibujar eventos ---
-        for idx_ev, evento in enumerate(eventos_dia):
-            hora_dt = evento["start_time"]
-
-            # Posición vertical basada en la hora
-            if 6 <= hora_dt.hour < 12:
-                y_base = y + cell_height_deseado * 0.75 + 24
-            elif 12 <= hora_dt.hour < 18:
-                y_base = y + cell_height_deseado * 0.5 + 21
-            else:
-                y_base = y + cell_height_deseado * 0.25 + 18
-
-            y_text = y_base - idx_ev * espacio_entre_eventos
-
-            # Título y hora en negrita
-            titulo = evento.get("title", "")
-            if titulo:
-                c.setFont("Helvetica-Bold", 16)
-                texto = f"{hora_dt.strftime('%H:%M')} - {titulo}"
-                x_centrado = (
-                    x
-                    + (cell_width_deseado - c.stringWidth(texto, "Helvetica-Bold", 13))
-                    / 2
-                )
-                c.drawString(x_centrado, y_text, texto)
-                y_text -= interlineado
-                c.setFont("Helvetica", 14)
-
-            # Atributos del evento
-            atributos = {
-                "Conductor": evento.get("conductor_name"),
-                "Ubicación": evento.get("location_name"),
-                "Territorio": f"{evento.get('territory_number')}"
-                if evento.get("territory_number")
-                else None,
-            }
-
-            for col_name, valor in atributos.items():
-                if valor:
-                    texto_attr = f"{col_name}: {valor}"
-                    x_centrado = (
-                        x
-                        + (
-                            cell_width_deseado
-                            - c.stringWidth(texto_attr, "Helvetica", 13)
-                        )
-                        / 2
-                    )
-                    c.drawString(x_centrado, y_text, texto_attr)
-
-                    # URL clicable para la ubicación
-                    if col_name == "Ubicación" and evento.get("url"):
-                        url = evento["url"]
-                        c.linkURL(
-                            url,
-                            (
-                                x_centrado,
-                                y_text,
-                                x_centrado + c.stringWidth(texto_attr, "Helvetica", 12),
-                                y_text + 12,
-                            ),
-                        )
-
-                    y_text -= interlineado
-
-            y_text -= espacio_entre_eventos
-
-    c.save()
-    buffer.seek(0)
-    return buffer
-
-
-@app.route("/generate_pdf", methods=["GET"])
-def generate_pdf():
+    if operations:
+        # Primero se registra el rango: si la escritura se corta, la próxima
+        # vez esas ocurrencias se leen igual
+        write_batch(
+            [
+                ("max", RECURRING_COLLECTION, template["id"], {"materialized_to": end_date.isoformat()})
+                for template in templates
+            ]
+        )
+        # Las ocurrencias ya creadas se sobrescriben: sus contadores viejos se
+        # restan (una sola lectura batch, solo de las que pueden existir)
+        templates_by_id = {template["id"]: template for template in templates}
+        previous = get_records_by_ids(
+            [
+                ("events", doc_id)
+                for _, _, doc_id, data in operations
+                if may_exist(templates_by_id[data["recurring_id"]], data["start_time"])
+            ]
+        )
+        write_events(
+            operations,
+            {doc_id: data for (_, doc_id), data in previous.items()},
+        )
+
+    return render_recurring_page(materialized=len(operations), skipped=skipped)
+
+
+@bp.route("/events/delete/<id>")
+def delete_event(id):
+    # Los eventos de meses archivados también se listan y se pueden borrar
+    for collection_name in ("events", ARCHIVE_COLLECTION):
+        event = get_record_by_id(collection_name, id)
+        if event is not None:
+            write_events([("delete", collection_name, id, None)], {id: event})
+            break
+    return redirect(url_for(".events_view"))
+
+
+def render_pdf(meses, events_range):
+    """Bytes del PDF de los meses pedidos (lo usa la caché de PDFs)."""
+    with timed("pdf"):
+        return generate_calendar_pdf(meses, events_range).getvalue()
+
+
+def get_pdf_events(meses):
+    """Eventos de los meses pedidos, con start_time convertido a datetime."""
+    # Corte de la copia en memoria: sin consultas ni strptime por evento
+    start, _ = month_bounds(*meses[0])
+    _, end = month_bounds(*meses[-1])
+    return event_snapshot().events_between(start, end, parse=True)
+
+
+def parse_pdf_params(args, default_months=1, max_months=12):
+    """Año, mes y cantidad de meses desde la URL o un formulario."""
+    now = datetime.now()
+    year = args.get("year", default=now.year, type=int)
+    month = args.get("month", default=now.month, type=int)
+    # Cantidad de meses a imprimir (1 = mensual, 3 = trimestral, 12 = anual)
+    months = args.get("months", default=default_months, type=int)
+    if not 1 <= month <= 12:
+        raise ValueError("Mes inválido")
+    return {"year": year, "month": month, "months": max(1, min(months, max_months))}
+
+
+def parse_pdf_batch_params(args):
+    return parse_pdf_params(args, default_months=12, max_months=24)
+
+
+def parse_ics_params(args):
+    year = args.get("year", type=int)
+    month = args.get("month", type=int)
+    if year is None or month is None or not 1 <= month <= 12:
+        raise ValueError("Mes o año inválido")
+    return {"year": year, "month": month}
+
+
+def range_filename(prefix, meses, extension):
+    """calendario_AAAA-MM.pdf o, para varios meses, calendario_AAAA-MM_AAAA-MM.pdf"""
+    first_year, first_month = meses[0]
+    filename = f"{prefix}_{datetime(first_year, first_month, 1).strftime('%Y-%m')}"
+    if len(meses) > 1:
+        last_year, last_month = meses[-1]
+        filename += f"_{datetime(last_year, last_month, 1).strftime('%Y-%m')}"
+    return f"{filename}.{extension}"
+
+
+def pdf_batch_entries(meses, events_range):
+    for pdf_year, pdf_month, pdf_bytes in render_months_parallel(meses, events_range):
+        filename = f"calendario_{datetime(pdf_year, pdf_month, 1).strftime('%Y-%m')}.pdf"
+        yield filename, pdf_bytes
+
+
+# --- Exportaciones en segundo plano (ver jobs_utils.py) ---
+def run_pdf_export(params, file):
+    meses = month_range(params["year"], params["month"], params["months"])
+    digest, events_range = pdf_cache_utils.lookup(meses, get_pdf_events)
+    file.write(
+        pdf_cache_utils.get_pdf(meses, digest, events_range, get_pdf_events, render_pdf)
+    )
+    return range_filename("calendario", meses, "pdf"), "application/pdf"
+
+
+def run_pdf_batch_export(params, file):
+    meses = month_range(params["year"], params["month"], params["months"])
+    for chunk in stream_zip(pdf_batch_entries(meses, get_pdf_events(meses))):
+        file.write(chunk)
+    return range_filename("calendarios", meses, "zip"), "application/zip"
+
+
+def run_ics_export(params, file):
+    start, end = month_bounds(params["year"], params["month"])
+    for chunk in stream_zip(write_calendars(event_snapshot().events_between(start, end))):
+        file.write(chunk)
+    return "calendarios.zip", "application/zip"
+
+
+# --- Programa en hoja de cálculo ---
+SCHEDULE_FIELDS = ["title", "start_time", "conductor_name", "location_name", "territory_number"]
+
+
+def parse_schedule_params(args):
+    """Rango de fechas (inclusive), formato y hojas por conductor."""
     try:
-        # Obtener mes y año de la URL
-        year = request.args.get("year", default=datetime.now().year, type=int)
-        month = request.args.get("month", default=datetime.now().month, type=int)
-
-        events_ref = db.collection("events")
-        # La consulta a Firestore no se puede hacer directamente con fechas,
-        # porque el campo `start_time` es una cadena.
-        # En su lugar, obtendremos todos los documentos y los filtraremos en Python.
-
-        query = events_ref.order_by("start_time").stream()
-
-        events_data = []
-        for doc in query:
-            event = doc.to_dict()
-            # Convertir la cadena 'start_time' a un objeto datetime
-            event["start_time"] = datetime.strptime(
-                event["start_time"], "%Y-%m-%dT%H:%M"
-            )
-            events_data.append(event)
+        start = datetime.strptime(args.get("start", ""), "%Y-%m-%d")
+        end = datetime.strptime(args.get("end", ""), "%Y-%m-%d")
+    except ValueError:
+        raise ValueError("Fechas inválidas (AAAA-MM-DD)")
+    if end < start:
+        raise ValueError("La fecha final es anterior a la inicial")
+    file_format = args.get("format", "xlsx")
+    if file_format not in ("csv", "xlsx"):
+        raise ValueError("Formato inválido: csv o xlsx")
+    return {
+        "start": start.strftime("%Y-%m-%d"),
+        "end": end.strftime("%Y-%m-%d"),
+        "format": file_format,
+        "per_conductor": file_format == "xlsx" and args.get("per_conductor") == "1",
+    }
+
+
+def schedule_events(params):
+    """Eventos del rango, leídos por páginas de start_time."""
+    end = datetime.strptime(params["end"], "%Y-%m-%d") + timedelta(days=1)
+    return iter_events_paged(
+        f"{params['start']}T00:00", end.strftime("%Y-%m-%dT%H:%M"), fields=SCHEDULE_FIELDS
+    )
+
 
-        # Filtramos los eventos en Python para que coincidan con el mes y año seleccionados
-        events_month = [
-            e
-            for e in events_data
-            if e["start_time"].year == year and e["start_time"].month == month
-        ]
+def schedule_filename(params):
+    return f"programa_{params['start']}_{params['end']}.{params['format']}"
 
-        print(f"✅ Found {len(events_month)} events for {month}/{year}.")
 
-        pdf_buffer = generate_pdf_from_firestore(year, month, events_month)
+def run_schedule_export(params, file):
+    if params["format"] == "csv":
+        for chunk in stream_csv(schedule_events(params)):
+            file.write(chunk)
+        return schedule_filename(params), "text/csv"
+    write_xlsx(schedule_events(params), file, per_conductor=params["per_conductor"])
+    return schedule_filename(params), XLSX_MIMETYPE
 
-        filename = f"calendario_{datetime(year, month, 1).strftime('%Y-%m')}.pdf"
-        return send_file(
-            pdf_buffer,
+
+def job_status(job):
+    status = {
+        "id": job["id"],
+        "status": job["status"],
+        "error": job.get("error"),
+        "status_url": url_for(".job_view", job_id=job["id"]),
+    }
+    if job["status"] == "done":
+        status["download_url"] = url_for(".job_download", job_id=job["id"])
+    return status
+
+
+@bp.route("/jobs", methods=["POST"])
+def submit_job():
+    """Registra una exportación (kind = pdf, pdf_batch, ics o schedule) y devuelve su estado."""
+    try:
+        job = submit_export(request.form.get("kind", ""), request.form)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(job_status(job)), 202
+
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+def job_view(job_id):
+    job = get_export(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(job_status(job))
+
+
+@bp.route("/jobs/<job_id>/download", methods=["GET"])
+def job_download(job_id):
+    job = get_export(job_id)
+    if job is None or job["status"] != "done":
+        return "El archivo no está listo.", 404
+    path = export_path(job_id)
+    if not os.path.exists(path):
+        return "El archivo ya no está disponible; vuelve a generarlo.", 410
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name=job["filename"],
+        mimetype=job["mimetype"],
+    )
+
+
+@bp.route("/generate_pdf", methods=["GET"])
+def generate_pdf():
+    try:
+        params = parse_pdf_params(request.args)
+        year, month, months = params["year"], params["month"], params["months"]
+        meses = month_range(year, month, months)
+
+        # Sin escrituras desde la última descarga no se consultan los eventos
+        digest, events_range = pdf_cache_utils.lookup(meses, get_pdf_events)
+        etag = f"pdf-{pdf_cache_utils.range_key(meses)}-{digest[:20]}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        if events_range is not None:
+            current_app.logger.info(
+                "%d eventos para %02d/%d (+%d meses)", len(events_range), month, year, months - 1
+            )
+        pdf_bytes = pdf_cache_utils.get_pdf(
+            meses, digest, events_range, get_pdf_events, render_pdf
+        )
+
+        filename = range_filename("calendario", meses, "pdf")
+        response = send_file(
+            io.BytesIO(pdf_bytes),
             as_attachment=True,
             download_name=filename,
             mimetype="application/pdf",
+            etag=etag,
         )
+        # Se revalida con el ETag en cada descarga
+        response.cache_control.no_cache = True
+        return response
 
-    except Exception as e:
-        print(f"❌ Error al generar el PDF: {e}")
+    except Exception:
+        current_app.logger.exception("Error al generar el PDF")
         return "Error al generar el PDF. Por favor, intente de nuevo.", 500
 
 
-@app.route("/pdf", methods=["GET"])
+@bp.route("/generate_pdf_batch", methods=["GET"])
+def generate_pdf_batch():
+    """ZIP con un PDF por mes; los meses se dibujan en paralelo y se envían al terminar."""
+    try:
+        params = parse_pdf_batch_params(request.args)
+        year, month, months = params["year"], params["month"], params["months"]
+
+        meses = month_range(year, month, months)
+        # Una sola consulta para todo el rango
+        events_range = get_pdf_events(meses)
+        current_app.logger.info(
+            "%d eventos para %02d/%d (+%d meses)", len(events_range), month, year, months - 1
+        )
+    except Exception:
+        current_app.logger.exception("Error al generar el PDF")
+        return "Error al generar el PDF. Por favor, intente de nuevo.", 500
+
+    filename = range_filename("calendarios", meses, "zip")
+    return Response(
+        timed_iter("pdf_batch", stream_zip(pdf_batch_entries(meses, events_range))),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
+@bp.route("/export_schedule", methods=["GET"])
+def export_schedule():
+    """Programa de cualquier rango de fechas en CSV o XLSX, enviado por partes."""
+    try:
+        params = parse_schedule_params(request.args)
+    except ValueError as e:
+        return str(e), 400
+
+    headers = {"Content-Disposition": f"attachment; filename={schedule_filename(params)}"}
+    if params["format"] == "csv":
+        return Response(
+            timed_iter("schedule", stream_csv(schedule_events(params))),
+            mimetype="text/csv",
+            headers=headers,
+        )
+
+    # openpyxl escribe las filas a disco; el archivo se envía por bloques
+    file = tempfile.TemporaryFile()
+    try:
+        with timed("schedule"):
+            write_xlsx(schedule_events(params), file, per_conductor=params["per_conductor"])
+    except Exception:
+        file.close()
+        current_app.logger.exception("Error al exportar el programa")
+        return "Error al exportar el programa.", 500
+    file.seek(0)
+    return send_file(
+        file,
+        as_attachment=True,
+        download_name=schedule_filename(params),
+        mimetype=XLSX_MIMETYPE,
+    )
+
+
+@bp.route("/stats", methods=["GET"])
+def stats_view():
+    """Eventos por mes, conductor y ubicación desde los contadores (12 lecturas por año)."""
+    year = request.args.get("year", default=datetime.now().year, type=int)
+    months = [f"{year}-{month:02d}" for month in range(1, 13)]
+    docs = get_records_by_ids([(STATS_COLLECTION, month) for month in months])
+
+    reference = get_cached_many(["conductors", "locations"])
+    names = {
+        "conductor": {item["id"]: item.get("name", "N/A") for item in reference["conductors"]},
+        "location": {item["id"]: item.get("name", "N/A") for item in reference["locations"]},
+    }
+    stats = summarize(
+        [(month, docs.get((STATS_COLLECTION, month))) for month in months], names
+    )
+    return render_template("stats.html", year=year, stats=stats)
+
+
+@bp.route("/pdf", methods=["GET"])
 def reportes_page():
     return render_template("pdf.html")
 
 
-@app.route("/link", methods=["GET"])
+@bp.route("/link", methods=["GET"])
 def link_page():
-    return render_template("link.html")
+    # URLs para suscribirse desde el calendario (webcal:// abre la app directamente)
+    feeds = {}
+    for variant in FEED_VARIANTS:
+        url = url_for(".calendar_feed", variant=variant, _external=True)
+        feeds[variant] = {"url": url, "webcal": "webcal://" + url.split("://", 1)[1]}
+    return render_template("link.html", feeds=feeds)
 
 
-@app.route("/export_ics", methods=["POST"])
+@bp.route("/export_ics", methods=["POST"])
 def export_ics():
     try:
         # Año y mes desde el formulario
-        year = int(request.form.get("year"))
-        month = int(request.form.get("month"))
+        params = parse_ics_params(request.form)
+        start, end = month_bounds(params["year"], params["month"])
+    except Exception:
+        current_app.logger.exception("Error al generar los ICS")
+        return "Error al generar los archivos ICS.", 500
 
-        start_of_month = datetime(year, month, 1)
-        end_of_month = datetime(
-            year, month, calendar.monthrange(year, month)[1], 23, 59, 59
-        )
+    # Una sola pasada por la consulta; el ZIP se envía a medida que se escribe
+    docs = event_snapshot().events_between(start, end)
+    filename = "calendarios.zip"
+    return Response(
+        timed_iter("ics", stream_zip(write_calendars(docs))),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
-        events_ref = db.collection("events")
-        docs = (
-            events_ref.where(
-                "start_time", ">=", start_of_month.strftime("%Y-%m-%dT%H:%M")
-            )
-            .where("start_time", "<=", end_of_month.strftime("%Y-%m-%dT%H:%M"))
-            .stream()
-        )
+# Feeds serializados, por variante, ventana y versión de la colección de eventos
+_feed_cache = LRUCache(maxsize=32)
+_feed_lock = threading.Lock()
 
-        # Dos calendarios
-        cal_apple = Calendar()
-        cal_google = Calendar()
 
-        for doc in docs:
-            event_data = doc.to_dict()
+def _clear_feed_cache():
+    with _feed_lock:
+        _feed_cache.clear()
 
-            # =====================
-            # Evento Apple
-            # =====================
-            e_apple = Event()
-            e_apple.name = f"Predicación - {event_data.get('title', 'Sin título')}"
 
-            # Fechas
-            try:
-                start_time_str = event_data.get("start_time")
-                start_time_dt = datetime.strptime(start_time_str, "%Y-%m-%dT%H:%M")
-                e_apple.begin = start_time_dt
-                e_apple.end = start_time_dt + timedelta(hours=2)
-            except (ValueError, TypeError):
-                continue
-
-            # Ubicación y URL
-            if event_data.get("location_name"):
-                e_apple.location = event_data["location_name"]
-            if event_data.get("url") and event_data["url"].startswith("http"):
-                e_apple.url = event_data["url"]
-
-            # Descripción
-            descripcion = []
-            if event_data.get("conductor_name"):
-                descripcion.append(f"Conductor: {event_data['conductor_name']}")
-            if event_data.get("territory_number"):
-                descripcion.append(f"Territorio: {event_data['territory_number']}")
-            e_apple.description = "\n".join(descripcion) if descripcion else None
-
-            cal_apple.events.add(e_apple)
-
-            # =====================
-            # Evento Google
-            # =====================
-            e_google = Event()
-            e_google.name = f"Predicación - {event_data.get('title', 'Sin título')}"
-
-            # Fechas
-            e_google.begin = e_apple.begin
-            e_google.end = e_apple.end
-
-            # Ubicación = URL
-            if event_data.get("url") and event_data["url"].startswith("http"):
-                e_google.location = event_data["url"]
-
-            # Descripción Google (Lugar + resto)
-            descripcion_google = []
-            if event_data.get("location_name"):
-                descripcion_google.append(f"Lugar: {event_data['location_name']}")
-            if event_data.get("conductor_name"):
-                descripcion_google.append(f"Conductor: {event_data['conductor_name']}")
-            if event_data.get("territory_number"):
-                descripcion_google.append(
-                    f"Territorio: {event_data['territory_number']}"
-                )
-            e_google.description = (
-                "\n".join(descripcion_google) if descripcion_google else None
-            )
+# Otro backend puede tener otros eventos con la misma versión
+on_backend_reset(_clear_feed_cache)
 
-            cal_google.events.add(e_google)
 
-        # Crear ZIP con ambos archivos
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.writestr(f"calendario_apple.ics", cal_apple.serialize())
-            zf.writestr(f"calendario_google.ics", cal_google.serialize())
-        buffer.seek(0)
+@bp.route("/calendar/<variant>.ics", methods=["GET"])
+def calendar_feed(variant):
+    """Calendario suscribible con ETag/Last-Modified y respuestas 304."""
+    if variant not in FEED_VARIANTS:
+        return "Calendario no encontrado.", 404
 
-        filename = f"calendarios.zip"
-        return send_file(
-            buffer,
-            as_attachment=True,
-            download_name=filename,
-            mimetype="application/zip",
-        )
+    # Ventana: `past` meses antes y `future` meses después del mes actual
+    past = max(0, min(request.args.get("past", default=1, type=int), 12))
+    future = max(0, min(request.args.get("future", default=3, type=int), 12))
+    now = datetime.now()
+    meses = month_range(now.year, now.month - past, past + future + 1)
+    start, _ = month_bounds(*meses[0])
+    _, end = month_bounds(*meses[-1])
 
-    except Exception as e:
-        print(f"Error al generar los ICS: {e}")
-        return "Error al generar los archivos ICS.", 500
+    # Una sola lectura (_meta/events) decide si el feed cambió
+    version, updated_at = get_collection_version("events")
+    last_modified = (
+        datetime.fromisoformat(updated_at) if updated_at else datetime(2000, 1, 1, tzinfo=timezone.utc)
+    )
+    # La generación del backend y la fecha de la versión distinguen dos
+    # conjuntos de datos con el mismo número de versión
+    etag = (
+        f"{variant}-{start[:7]}-{end[:7]}-g{backend_generation()}"
+        f"-v{version}-{int(last_modified.timestamp())}"
+    )
 
-@app.route('/site.webmanifest')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        with _feed_lock:
+            body = _feed_cache.get(etag)
+        if body is None:
+            dtstamp = format_datetime(last_modified)
+            with timed("ics_feed"):
+                body = "".join(
+                    write_feed(event_snapshot().events_between(start, end), variant, dtstamp)
+                ).encode("utf-8")
+            with _feed_lock:
+                _feed_cache[etag] = body
+        response = Response(body, mimetype="text/calendar")
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+
+@bp.route('/site.webmanifest')
 def manifest():
-    return app.send_static_file('icons/site.webmanifest')
+    return current_app.send_static_file('icons/site.webmanifest')
+
+
+@bp.route('/sw.js')
+def service_worker():
+    # Desde la raíz para que el service worker controle todas las páginas
+    response = current_app.send_static_file('sw.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@click.command("backfill-stats")
+def backfill_stats_command():
+    """Recalcula los contadores de estadísticas a partir de todos los eventos."""
+    months = rebuild_stats()
+    click.echo(f"Estadísticas recalculadas para {len(months)} meses.")
+
+
+@click.command("archive-events")
+@click.option(
+    "--before",
+    type=int,
+    default=None,
+    help="Archivar los eventos anteriores al 1 de enero de este año.",
+)
+def archive_events_command(before):
+    """Mueve los eventos de años anteriores a la colección de archivo."""
+    moved = archive_events(before)
+    click.echo(f"{moved} eventos archivados.")
+
+
+def create_app():
+    """Crea la aplicación Flask con las rutas, las métricas y los listeners."""
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY")
+    app.register_blueprint(bp)
+    # flask --app app backfill-stats
+    app.cli.add_command(backfill_stats_command)
+    # flask --app app archive-events [--before AÑO]
+    app.cli.add_command(archive_events_command)
+
+    # Latencia por ruta, lecturas/escrituras por request y /metrics (ver metrics.py)
+    metrics.init_app(app)
+
+    # PDFs del mes actual y el siguiente listos después de cada escritura
+    pdf_cache_utils.start_prerender(get_pdf_events, render_pdf)
+
+    # Exportaciones en segundo plano desde /pdf y /link (ver jobs_utils.py)
+    register_exporter("pdf", parse_pdf_params, run_pdf_export)
+    register_exporter("pdf_batch", parse_pdf_batch_params, run_pdf_batch_export)
+    register_exporter("ics", parse_ics_params, run_ics_export)
+    register_exporter("schedule", parse_schedule_params, run_schedule_export)
+
+    # Listeners opcionales para mantener la caché de referencia al día
+    if os.getenv("FIRESTORE_LISTENERS") == "1":
+        start_reference_listeners()
+
+    app.logger.info(
+        "Aplicación lista en %.1f ms (importación %.1f ms)",
+        (time.perf_counter() - _IMPORT_STARTED) * 1000,
+        (started - _IMPORT_STARTED) * 1000,
+    )
+    return app
+
+
+# Para `gunicorn app:app` y `python app.py`
+app = create_app()
 
 
 if __name__ == "__main__":
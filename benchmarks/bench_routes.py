@@ -0,0 +1,401 @@
+"""Benchmark de las rutas más usadas contra un backend SQLite local.
+
+Siembra un conjunto sintético de eventos (1k, 10k, 100k...) en una base SQLite
+temporal, ejecuta las rutas con el cliente de prueba de Flask y reporta por
+ruta: latencias p50/p95/p99, documentos leídos y escritos por request, memoria
+pico y tiempo total. También mide el arranque (`import app`) en procesos
+nuevos. Los resultados se guardan en JSON para compararlos entre commits:
+
+    python benchmarks/bench_routes.py --sizes 1000 10000 --output base.json
+    python benchmarks/bench_routes.py --sizes 1000 10000 --compare base.json
+
+Con --compare el script termina con código 1 si alguna ruta empeora más que
+--threshold (por defecto 20%) en p95 o en documentos leídos.
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["STORAGE_BACKEND"] = "sqlite"
+# Sin PDFs dibujados en segundo plano durante las mediciones
+os.environ["PDF_PRERENDER_MONTHS"] = "0"
+
+from storage import SQLiteBackend, StorageBackend, set_backend  # noqa: E402
+
+TITLES = ["Mañana", "Tarde", "Pública", "Cartas", "Viloma Cala Cala"]
+HOURS = [7, 9, 10, 15, 16, 19]
+
+
+class CountingBackend(StorageBackend):
+    """Envuelve un backend y cuenta documentos leídos y escritos."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        # Por request, como en metrics.py: fetch_parallel copia el contexto a
+        # sus hilos, así que sus lecturas suman al mismo contador
+        self._counts = contextvars.ContextVar("bench_counts", default=None)
+        self._lock = threading.Lock()
+
+    @property
+    def counts(self):
+        counts = self._counts.get()
+        if counts is None:
+            counts = {"reads": 0, "writes": 0}
+            self._counts.set(counts)
+        return counts
+
+    def reset(self):
+        self._counts.set({"reads": 0, "writes": 0})
+
+    def _count(self, kind, amount=1):
+        counts = self.counts
+        with self._lock:
+            counts[kind] += amount
+
+    def __getattr__(self, name):
+        # Operaciones que no se cuentan (por ejemplo, las agregadas más adelante)
+        return getattr(self.inner, name)
+
+    def query(self, *args, **kwargs):
+        for doc in self.inner.query(*args, **kwargs):
+            self._count("reads")
+            yield doc
+
+    def get(self, collection, doc_id):
+        self._count("reads")
+        return self.inner.get(collection, doc_id)
+
+    def get_many(self, keys):
+        result = self.inner.get_many(keys)
+        self._count("reads", len(result))
+        return result
+
+    def add(self, collection, data):
+        self._count("writes")
+        return self.inner.add(collection, data)
+
+    def create(self, collection, doc_id, data):
+        self._count("writes")
+        return self.inner.create(collection, doc_id, data)
+
+    def update(self, collection, doc_id, data):
+        self._count("writes")
+        return self.inner.update(collection, doc_id, data)
+
+    def delete(self, collection, doc_id):
+        self._count("writes")
+        return self.inner.delete(collection, doc_id)
+
+    def increment(self, collection, doc_id, amounts, extra=None):
+        self._count("writes")
+        return self.inner.increment(collection, doc_id, amounts, extra)
+
+    def batch_write(self, operations):
+        self._count("writes", len(operations))
+        return self.inner.batch_write(operations)
+
+
+def seed(backend, size, months, seed_value=42):
+    """Carga `size` eventos repartidos en `months` meses hasta el mes actual."""
+    rng = random.Random(seed_value)
+
+    locations = [backend.add("locations", {"name": f"Lugar {i}", "url": f"https://maps.example/{i}"}) for i in range(20)]
+    conductors = [backend.add("conductors", {"name": f"Conductor {i}"}) for i in range(30)]
+    territories = [backend.add("territories", {"number": i}) for i in range(1, 61)]
+
+    now = datetime.now()
+    first_day = datetime(now.year, now.month, 1) - timedelta(days=30 * (months - 1))
+    span_days = (now - first_day).days + 28
+
+    rows = []
+    for i in range(size):
+        day = first_day + timedelta(days=rng.randrange(span_days))
+        start = day.replace(hour=rng.choice(HOURS), minute=0)
+        event = {
+            "title": rng.choice(TITLES),
+            "start_time": start.strftime("%Y-%m-%dT%H:%M"),
+            "location_name": f"Lugar {rng.randrange(20)}",
+            "url": "https://maps.example/x",
+            "conductor_name": f"Conductor {rng.randrange(30)}",
+            "territory_number": ", ".join(str(rng.randint(1, 60)) for _ in range(2)),
+        }
+        rows.append(("events", f"ev{i:08d}", json.dumps(event)))
+
+    # Carga masiva en una sola transacción para no medir la siembra
+    with backend.conn as conn:
+        conn.executemany(
+            "INSERT INTO documents (collection, id, data) VALUES (?, ?, ?)", rows
+        )
+    return locations, conductors, territories
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_route(app, counter, name, call, requests, concurrency):
+    """Ejecuta `call(client)` `requests` veces y devuelve las métricas."""
+    latencies = []
+    reads = []
+    writes = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(n):
+        nonlocal errors
+        client = app.test_client()
+        for _ in range(n):
+            counter.reset()
+            started = time.perf_counter()
+            response = call(client)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed * 1000)
+                reads.append(counter.counts["reads"])
+                writes.append(counter.counts["writes"])
+                # 409: evento aleatorio superpuesto con otro (se rechaza, no es un error)
+                if response.status_code >= 400 and response.status_code != 409:
+                    errors += 1
+
+    # Una pasada aparte con tracemalloc para la memoria pico
+    tracemalloc.start()
+    call(app.test_client())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_worker = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_worker[i] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, [n for n in per_worker if n]))
+    total = time.perf_counter() - started
+
+    return {
+        "route": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "throughput_rps": round(requests / total, 2),
+        "docs_read": round(statistics.mean(reads), 1),
+        "docs_written": round(statistics.mean(writes), 1),
+        "peak_mem_kb": round(peak / 1024, 1),
+    }
+
+
+def bench_size(size, args):
+    # Los módulos se importan antes de cambiar el backend: set_backend vacía
+    # sus cachés (las del tamaño anterior)
+    import firebase_utils  # noqa: F401
+    import pdf_cache_utils
+    from app import app
+
+    tmpdir = tempfile.mkdtemp(prefix="jwplan-bench-")
+    inner = SQLiteBackend(os.path.join(tmpdir, "bench.db"))
+    locations, conductors, territories = seed(inner, size, args.months)
+
+    # Con los datos ya cargados: set_backend vacía las cachés de todos los
+    # módulos (referencias, reservas, archivo, PDFs, feeds) y la copia en
+    # memoria de los eventos se arma de nuevo porque cambió el backend
+    counter = CountingBackend(inner)
+    set_backend(counter)
+
+    now = datetime.now()
+    year, month = now.year, now.month
+    rng = random.Random(size)
+
+    def add_event(client):
+        start = now + timedelta(days=rng.randrange(60), hours=rng.randrange(12))
+        return client.post(
+            "/events/add",
+            data={
+                "title": rng.choice(TITLES),
+                "start_time": start.strftime("%Y-%m-%dT%H:%M"),
+                "location_id": rng.choice(locations),
+                "conductor_id": rng.choice(conductors),
+                "territories_list": ",".join(rng.sample(territories, 10)),
+            },
+        )
+
+    routes = [
+        ("GET /events", lambda c: c.get("/events"), args.requests, args.concurrency),
+        (
+            "GET /api/events",
+            lambda c: c.get(f"/api/events?year={year}&month={month}&limit=200"),
+            args.requests,
+            args.concurrency,
+        ),
+        (
+            "GET /generate_pdf",
+            lambda c: c.get(f"/generate_pdf?year={year}&month={month}"),
+            args.heavy_requests,
+            args.concurrency,
+        ),
+        (
+            "GET /generate_pdf frío",
+            lambda c: (pdf_cache_utils.clear(), c.get(f"/generate_pdf?year={year}&month={month}"))[1],
+            args.heavy_requests,
+            args.concurrency,
+        ),
+        (
+            "GET /calendar feed",
+            lambda c: c.get("/calendar/google.ics"),
+            args.requests,
+            args.concurrency,
+        ),
+        (
+            "POST /export_ics",
+            lambda c: c.post("/export_ics", data={"year": year, "month": month}),
+            args.heavy_requests,
+            args.concurrency,
+        ),
+        ("POST /events/add", add_event, args.requests, 1),
+    ]
+
+    results = []
+    for name, call, requests, concurrency in routes:
+        if args.routes and not any(r in name for r in args.routes):
+            continue
+        result = run_route(app, counter, name, call, requests, concurrency)
+        result["size"] = size
+        results.append(result)
+        print(
+            f"{size:>7} {name:<20} p50={result['p50_ms']:>9.2f}ms "
+            f"p95={result['p95_ms']:>9.2f}ms reads={result['docs_read']:>8} "
+            f"writes={result['docs_written']:>4} mem={result['peak_mem_kb']:>9}KB "
+            f"errors={result['errors']}"
+        )
+    return results
+
+
+STARTUP_SNIPPET = """
+import time
+started = time.perf_counter()
+import app
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def bench_startup(runs):
+    """Tiempo de `import app` (crear la aplicación) en procesos nuevos."""
+    env = dict(os.environ, SQLITE_PATH=":memory:", LOG_LEVEL="WARNING")
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", STARTUP_SNIPPET], cwd=ROOT, env=env, text=True
+        )
+        times.append(float(output.strip().splitlines()[-1]))
+
+    result = {
+        "route": "startup (import app)",
+        "size": 0,
+        "requests": runs,
+        "concurrency": 1,
+        "errors": 0,
+        "p50_ms": round(percentile(times, 50), 3),
+        "p95_ms": round(percentile(times, 95), 3),
+        "p99_ms": round(percentile(times, 99), 3),
+        "mean_ms": round(statistics.mean(times), 3),
+        "throughput_rps": None,
+        "docs_read": 0,
+        "docs_written": 0,
+        "peak_mem_kb": None,
+    }
+    print(f"{'':>7} {result['route']:<20} p50={result['p50_ms']:>9.2f}ms p95={result['p95_ms']:>9.2f}ms")
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Imprime la diferencia con una corrida anterior; True si hay regresiones."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {(r["size"], r["route"]): r for r in baseline["results"]}
+
+    regressions = False
+    print(f"\nComparación con {baseline_path} ({baseline.get('revision')})")
+    for result in results:
+        old = previous.get((result["size"], result["route"]))
+        if not old:
+            continue
+        for metric in ("p95_ms", "docs_read"):
+            before, after = old[metric], result[metric]
+            change = (after - before) / before if before else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  <-- REGRESIÓN"
+                regressions = True
+            print(
+                f"{result['size']:>7} {result['route']:<20} {metric:<9} "
+                f"{before:>10} -> {after:>10} ({change:+.1%}){flag}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--months", type=int, default=24, help="meses de historia sembrados")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--heavy-requests", type=int, default=10, help="requests para PDF/ICS")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--routes", nargs="*", help="filtrar rutas por nombre")
+    parser.add_argument("--output", help="guardar resultados en JSON")
+    parser.add_argument("--compare", help="JSON de una corrida anterior")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--startup-runs", type=int, default=5, help="0 para no medir el arranque")
+    args = parser.parse_args()
+
+    results = []
+    if args.startup_runs:
+        results.append(bench_startup(args.startup_runs))
+    for size in args.sizes:
+        results.extend(bench_size(size, args))
+
+    report = {
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "params": vars(args),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
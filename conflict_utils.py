@@ -0,0 +1,98 @@
+"""Detección de superposiciones de conductores y ubicaciones.
+
+Cada evento ocupa a su conductor y a su ubicación durante EVENT_DURATION.
+`BookingIndex` guarda, por conductor y por ubicación, las horas de inicio
+ordenadas, así que revisar un evento nuevo es una búsqueda binaria por clave
+en lugar de recorrer los eventos. firebase_utils mantiene un índice por mes en
+memoria (ver get_booking_index).
+"""
+
+from bisect import bisect_right, insort
+from datetime import datetime, timedelta
+
+# Duración de un evento (también el DTEND de los calendarios ICS)
+EVENT_DURATION = timedelta(hours=2)
+
+# Dimensión -> (campo con el id, campo con el nombre, etiqueta)
+BOOKING_DIMENSIONS = {
+    "conductor": ("conductor_id", "conductor_name", "El conductor"),
+    "location": ("location_id", "location_name", "La ubicación"),
+}
+
+# Campos que necesita el índice (lectura acotada)
+BOOKING_FIELDS = ["title", "start_time"] + [
+    field for id_field, name_field, _ in BOOKING_DIMENSIONS.values() for field in (id_field, name_field)
+]
+
+
+def parse_start(event):
+    try:
+        return datetime.strptime(event.get("start_time"), "%Y-%m-%dT%H:%M")
+    except (ValueError, TypeError):
+        return None
+
+
+def booking_months(event):
+    """Meses ("AAAA-MM") cuyos eventos pueden superponerse con `event`."""
+    start = parse_start(event)
+    if start is None:
+        return []
+    return sorted(
+        {(start - EVENT_DURATION).strftime("%Y-%m"), (start + EVENT_DURATION).strftime("%Y-%m")}
+    )
+
+
+def booking_keys(event):
+    """Claves del índice: por id y, para eventos antiguos sin id, también por nombre."""
+    keys = []
+    for dimension, (id_field, name_field, _) in BOOKING_DIMENSIONS.items():
+        if event.get(id_field):
+            keys.append((dimension, "id", event[id_field]))
+        name = event.get(name_field)
+        if name and name != "N/A":
+            keys.append((dimension, "name", name))
+    return keys
+
+
+class BookingIndex:
+    """Inicios de los eventos ordenados por conductor y por ubicación."""
+
+    def __init__(self, events=()):
+        self._starts = {}
+        self._events = {}
+        for event in events:
+            self.add(event)
+
+    def add(self, event, event_id=None):
+        start = parse_start(event)
+        if start is None:
+            return
+        event_id = event_id or event.get("id")
+        self._events[event_id] = event
+        for key in booking_keys(event):
+            insort(self._starts.setdefault(key, []), (start, event_id))
+
+    def conflicts(self, event):
+        """Devuelve [(dimensión, evento existente)] que se superponen con `event`."""
+        start = parse_start(event)
+        if start is None:
+            return []
+
+        found = {}
+        for dimension, kind, value in booking_keys(event):
+            starts = self._starts.get((dimension, kind, value), ())
+            # Superposición: |inicio - otro inicio| < EVENT_DURATION
+            index = bisect_right(starts, (start - EVENT_DURATION, "\uffff"))
+            while index < len(starts) and starts[index][0] < start + EVENT_DURATION:
+                other_id = starts[index][1]
+                if other_id != event.get("id"):
+                    found.setdefault((dimension, other_id), self._events[other_id])
+                index += 1
+        return [(dimension, other) for (dimension, _), other in found.items()]
+
+
+def describe_conflict(dimension, other):
+    """Mensaje para el usuario, por ejemplo "El conductor Juan ya tiene Mañana (2026-10-05 09:00)"."""
+    _, name_field, label = BOOKING_DIMENSIONS[dimension]
+    start = (other.get("start_time") or "").replace("T", " ")
+    return f"{label} {other.get(name_field, 'N/A')} ya tiene {other.get('title', 'un evento')} ({start})"
@@ -0,0 +1,134 @@
+"""Descargas generadas por partes: ZIP y programa en CSV / XLSX.
+
+Nada se arma completo en memoria: el ZIP y el CSV se entregan por fragmentos y
+el XLSX usa el modo write-only de openpyxl, que escribe las filas a disco.
+"""
+
+import csv
+import io
+import re
+import zipfile
+from datetime import datetime
+
+# Columnas del programa exportado a hoja de cálculo
+SCHEDULE_COLUMNS = ("Fecha", "Hora", "Título", "Conductor", "Ubicación", "Territorios")
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Filas por fragmento del CSV
+CSV_CHUNK_ROWS = 500
+
+
+class _ChunkBuffer:
+    """Destino de escritura para ZipFile que acumula bytes hasta que se leen.
+
+    No implementa seek/tell, así que ZipFile escribe en modo streaming (con
+    data descriptors) y nunca necesita volver atrás.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """Genera un ZIP por partes a partir de (nombre, contenido).
+
+    `contenido` puede ser bytes o un iterable de fragmentos de bytes. Cada
+    fragmento comprimido se entrega en cuanto está listo, así que el ZIP
+    completo nunca está en memoria.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", compression) as zf:
+        for name, content in entries:
+            if isinstance(content, (bytes, bytearray)):
+                content = (content,)
+            with zf.open(name, "w") as f:
+                for chunk in content:
+                    f.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    data = buffer.drain()
+    if data:
+        yield data
+
+
+def schedule_row(event, typed=False):
+    """Fila del programa; con `typed`, fecha y hora como date / time (para XLSX)."""
+    start_time = event.get("start_time") or ""
+    day, hour = start_time[:10], start_time[11:16]
+    if typed:
+        try:
+            start = datetime.strptime(start_time, "%Y-%m-%dT%H:%M")
+            day, hour = start.date(), start.time()
+        except ValueError:
+            pass
+    return [
+        day,
+        hour,
+        event.get("title", ""),
+        event.get("conductor_name", ""),
+        event.get("location_name", ""),
+        event.get("territory_number", ""),
+    ]
+
+
+def stream_csv(events):
+    """Genera el programa como CSV (UTF-8 con BOM, para Excel) por fragmentos."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(SCHEDULE_COLUMNS)
+    for count, event in enumerate(events, start=1):
+        writer.writerow(schedule_row(event))
+        if count % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def _sheet_title(name, used):
+    """Nombre de hoja válido para Excel (máx. 31 caracteres, sin []:*?/\\) y único."""
+    base = re.sub(r"[\[\]:*?/\\]", " ", str(name)).strip()[:31] or "Sin nombre"
+    title, suffix = base, 2
+    while title.lower() in used:
+        title = f"{base[:31 - len(str(suffix)) - 3]} ({suffix})"
+        suffix += 1
+    used.add(title.lower())
+    return title
+
+
+def write_xlsx(events, file, per_conductor=False):
+    """Escribe el programa en un XLSX; con `per_conductor`, además una hoja por conductor."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    used = set()
+    main = workbook.create_sheet(_sheet_title("Programa", used))
+    main.append(SCHEDULE_COLUMNS)
+    sheets = {}
+    for event in events:
+        row = schedule_row(event, typed=True)
+        main.append(row)
+        if per_conductor:
+            name = event.get("conductor_name") or "Sin conductor"
+            sheet = sheets.get(name)
+            if sheet is None:
+                sheet = sheets[name] = workbook.create_sheet(_sheet_title(name, used))
+                sheet.append(SCHEDULE_COLUMNS)
+            sheet.append(row)
+    workbook.save(file)
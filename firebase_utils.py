@@ -1,68 +1,881 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+import contextvars
+import heapq
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 
-cred = credentials.Certificate("key.json")
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+from cachetools import TTLCache
+
+from conflict_utils import BOOKING_FIELDS, BookingIndex, booking_months
+from stats_utils import (
+    STATS_COLLECTION,
+    TERRITORY_STATS_COLLECTION,
+    event_counters,
+    event_territories,
+    stats_months,
+    stats_operations,
+    territory_changes,
+)
+from storage import BATCH_LIMIT, get_backend, on_backend_reset
+
+logger = logging.getLogger(__name__)
+
+# --- Caché de datos de referencia ---
+# Ubicaciones, conductores y territorios cambian muy poco, así que se guardan
+# en memoria con un TTL. Las rutas que escriben en estas colecciones llaman a
+# invalidate_cache() y, si se activan los listeners, el backend los mantiene
+# actualizados (on_snapshot en Firestore).
+REFERENCE_COLLECTIONS = ("locations", "conductors", "territories")
+REFERENCE_ORDER = {"territories": "number"}
+REFERENCE_CACHE_TTL = int(os.getenv("REFERENCE_CACHE_TTL", "300"))
+
+_reference_cache = TTLCache(maxsize=len(REFERENCE_COLLECTIONS), ttl=REFERENCE_CACHE_TTL)
+_cache_lock = threading.Lock()
+_listeners = {}
+
+# --- Lecturas en paralelo ---
+# Pool compartido para las rutas que necesitan varias colecciones a la vez;
+# la latencia queda en aproximadamente una ida y vuelta en lugar de la suma.
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+_fetch_executor = ThreadPoolExecutor(
+    max_workers=FETCH_WORKERS, thread_name_prefix="fetch"
+)
+
+# --- Versión de colecciones ---
+# Cada escritura en estas colecciones incrementa `_meta/{colección}.version`.
+# Leer ese único documento basta para saber si algo cambió (feeds ICS, cachés).
+VERSIONED_COLLECTIONS = ("events",)
+META_COLLECTION = "_meta"
+
+# colección -> funciones a llamar después de cada escritura de este proceso
+_write_listeners = {}
+
+# --- Sincronización incremental ---
+# Cada escritura de un evento guarda `updated_at`; los borrados dejan una
+# marca en DELETED_EVENTS_COLLECTION con `deleted_at`. Así /api/events/changes
+# devuelve solo lo que cambió desde la última sincronización del cliente.
+# archive_events también deja una marca por cada evento que mueve a
+# ARCHIVE_COLLECTION: para la sincronización "borrado" significa "ya no está en
+# la colección de eventos", no necesariamente borrado por un usuario. Los
+# clientes piden los meses anteriores a get_archive_cutoff() al servidor.
+DELETED_EVENTS_COLLECTION = "deleted_events"
+# Margen del token de sincronización: las escrituras en curso al responder
+# pueden tener un updated_at algo anterior
+SYNC_OVERLAP = timedelta(seconds=30)
+# Las marcas de borrado se guardan este tiempo; un cliente con un token más
+# viejo puede no enterarse de algún borrado y tiene que sincronizar todo
+DELETED_EVENTS_RETENTION = timedelta(days=int(os.getenv("DELETED_EVENTS_RETENTION_DAYS", "30")))
+# Segundos entre limpiezas de marcas viejas (después de escribir eventos)
+PRUNE_INTERVAL = 3600
+_last_prune = 0.0
+
+# --- Archivo de años anteriores ---
+# Los eventos anteriores al corte (inicio de un mes, guardado en
+# `_meta/events_archive.before`) se mueven a ARCHIVE_COLLECTION, así la
+# colección de eventos solo crece con los años en uso. Las consultas por rango
+# leen de una, de otra o de ambas según el rango pedido; los meses archivados
+# también miran la colección de eventos, por si se agregó algo con fecha vieja
+# después de archivar.
+ARCHIVE_COLLECTION = "events_archive"
+# Años completos anteriores al actual que quedan en la colección de eventos
+ARCHIVE_KEEP_YEARS = int(os.getenv("ARCHIVE_KEEP_YEARS", "1"))
+# Tres escrituras por evento: copia, borrado y marca de borrado
+ARCHIVE_BATCH = BATCH_LIMIT // 3
+_archive_cutoff = TTLCache(maxsize=1, ttl=REFERENCE_CACHE_TTL)
+
+# --- Índice de reservas ---
+# Por mes, los inicios de los eventos de cada conductor y ubicación, para
+# detectar superposiciones sin consultar por cada evento nuevo. write_events
+# agrega los eventos nuevos al índice en memoria y descarta los meses con
+# cambios o borrados; el TTL cubre las escrituras de otros procesos.
+BOOKING_CACHE_TTL = int(os.getenv("BOOKING_CACHE_TTL", "60"))
+_booking_cache = TTLCache(maxsize=24, ttl=BOOKING_CACHE_TTL)
+_booking_lock = threading.Lock()
 
 # Nueva función para obtener un solo documento por ID y colección
 def get_record_by_id(collection_name, doc_id):
-    doc_ref = db.collection(collection_name).document(doc_id)
-    doc = doc_ref.get()
-    if doc.exists:
-        return doc.to_dict()
-    return None
+    return get_backend().get(collection_name, doc_id)
+
+def get_records_by_ids(keys):
+    """Fetch several documents in a single round trip.
+
+    `keys` is an iterable of (collection_name, doc_id); returns a dict with the
+    same keys for the documents that exist.
+    """
+    keys = list(dict.fromkeys((col, doc_id) for col, doc_id in keys if doc_id))
+    if not keys:
+        return {}
+    return get_backend().get_many(keys)
+
+
+# Campo de referencia del evento -> (colección, campo resuelto, campo leído, valor por defecto)
+EVENT_REFERENCES = {
+    'location': ('locations', 'location_name', 'name', 'Unknown Location'),
+    'conductor': ('conductors', 'conductor_name', 'name', 'Unknown Conductor'),
+    'territory': ('territories', 'territory_number', 'number', 'N/A'),
+}
+
 
 def resolve_event_references(events):
-    # Crear cachés para evitar múltiples lecturas de la base de datos
-    locations_cache = {}
-    conductors_cache = {}
-    territories_cache = {}
-    
+    # Los datos de referencia se leen de la caché en memoria; lo que no esté
+    # (por ejemplo, documentos recién creados) se trae en una sola lectura batch.
+    collections = [collection for collection, _, _, _ in EVENT_REFERENCES.values()]
+    caches = {
+        collection: {(collection, item["id"]): item for item in items}
+        for collection, items in get_cached_many(collections).items()
+    }
+
+    backend = get_backend()
+    missing = set()
+    for event in events:
+        for ref_field, (collection, _, _, _) in EVENT_REFERENCES.items():
+            ref_id = backend.reference_id(event.get(ref_field))
+            if ref_id and (collection, ref_id) not in caches[collection]:
+                missing.add((collection, ref_id))
+
+    for key, data in get_records_by_ids(missing).items():
+        caches[key[0]][key] = data
+
     for event in events:
-        # Resolver Location
-        if 'location' in event and isinstance(event['location'], firestore.DocumentReference):
-            loc_id = event['location'].id
-            if loc_id not in locations_cache:
-                loc_data = get_record_by_id('locations', loc_id)
-                locations_cache[loc_id] = loc_data['name'] if loc_data and 'name' in loc_data else 'Unknown Location'
-            event['location_name'] = locations_cache[loc_id]
-
-        # Resolver Conductor
-        if 'conductor' in event and isinstance(event['conductor'], firestore.DocumentReference):
-            con_id = event['conductor'].id
-            if con_id not in conductors_cache:
-                con_data = get_record_by_id('conductors', con_id)
-                conductors_cache[con_id] = con_data['name'] if con_data and 'name' in con_data else 'Unknown Conductor'
-            event['conductor_name'] = conductors_cache[con_id]
-        
-        # Resolver Territory
-        if 'territory' in event and isinstance(event['territory'], firestore.DocumentReference):
-            ter_id = event['territory'].id
-            if ter_id not in territories_cache:
-                ter_data = get_record_by_id('territories', ter_id)
-                territories_cache[ter_id] = ter_data['number'] if ter_data and 'number' in ter_data else 'N/A'
-            event['territory_number'] = territories_cache[ter_id]
+        for ref_field, (collection, target, source, default) in EVENT_REFERENCES.items():
+            ref_id = backend.reference_id(event.get(ref_field))
+            if ref_id:
+                data = caches[collection].get((collection, ref_id))
+                event[target] = data[source] if data and source in data else default
 
     return events
 
-# Firestore utility functions
-def get_all(collection_name):
+def build_event_data(title, start_time, location_data, conductor_data, territories_data):
+    """Build the denormalized event document stored in 'events'.
+
+    Names, URL and territory numbers are copied into the event so that reads
+    never need to join the reference collections. The location and conductor
+    ids are stored too, so renames can be propagated (see propagation_utils).
+    """
+    # 🗺️ Unir los números de territorio en un solo string
+    territory_numbers = [
+        str(territory_data.get("number", "N/A")) for territory_data in territories_data
+    ]
+    return {
+        "title": title,
+        "start_time": start_time,
+        "location_name": location_data.get("name", "N/A") if location_data else "N/A",
+        "url": location_data.get("url", "N/A") if location_data else "N/A",
+        "conductor_name": conductor_data.get("name", "N/A")
+        if conductor_data
+        else "N/A",
+        "territory_number": ", ".join(territory_numbers),
+        # Referencias como lista, para el índice de territorios
+        "territory_ids": [
+            territory_data["id"]
+            for territory_data in territories_data
+            if territory_data.get("id")
+        ],
+        "location_id": location_data.get("id") if location_data else None,
+        "conductor_id": conductor_data.get("id") if conductor_data else None,
+    }
+
+
+# Storage utility functions
+def get_all(collection_name, order_by=None):
     """Return all documents from a collection as a list of dicts with id"""
-    docs = db.collection(collection_name).stream()
+    return list(get_backend().stream(collection_name, order_by=order_by))
+
+
+def get_cached(collection_name):
+    """Return a reference collection from the in-memory cache, loading it on a miss"""
+    with _cache_lock:
+        data = _reference_cache.get(collection_name)
+    if data is None:
+        data = get_all(collection_name, order_by=REFERENCE_ORDER.get(collection_name))
+        with _cache_lock:
+            _reference_cache[collection_name] = data
+    # Copias para que los llamadores puedan modificar los dicts sin tocar la caché
+    return [dict(item) for item in data]
+
+
+def fetch_parallel(calls):
+    """Run independent read callables concurrently and return {name: result}"""
+    if len(calls) <= 1:
+        return {name: fn() for name, fn in calls.items()}
+    # Cada hilo corre con una copia del contexto (métricas del request en curso)
+    futures = {
+        name: _fetch_executor.submit(contextvars.copy_context().run, fn)
+        for name, fn in calls.items()
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+
+def get_cached_many(collection_names):
+    """Return several reference collections, loading the cache misses in parallel"""
+    result = {}
+    with _cache_lock:
+        for name in collection_names:
+            data = _reference_cache.get(name)
+            if data is not None:
+                result[name] = [dict(item) for item in data]
+    missing = [name for name in collection_names if name not in result]
+    result.update(
+        fetch_parallel({name: (lambda name=name: get_cached(name)) for name in missing})
+    )
+    return result
+
+
+def invalidate_cache(collection_name=None):
+    """Drop one cached collection, or all of them if no name is given"""
+    with _cache_lock:
+        if collection_name is None:
+            _reference_cache.clear()
+        else:
+            _reference_cache.pop(collection_name, None)
+
+
+def _reset_caches():
+    """Vacía las cachés en memoria (son de los datos del backend anterior)"""
+    invalidate_cache()
+    _archive_cutoff.clear()
+    with _booking_lock:
+        _booking_cache.clear()
+
+
+on_backend_reset(_reset_caches)
+
+
+def start_reference_listeners():
+    """Keep the reference cache fresh with backend listeners (Firestore on_snapshot)"""
+    for collection_name in REFERENCE_COLLECTIONS:
+        if collection_name in _listeners:
+            continue
+
+        def on_change(data, name=collection_name):
+            order_field = REFERENCE_ORDER.get(name)
+            if order_field:
+                data.sort(key=lambda item: item.get(order_field, 0))
+            with _cache_lock:
+                _reference_cache[name] = data
+
+        watch = get_backend().watch(collection_name, on_change)
+        if watch is not None:
+            _listeners[collection_name] = watch
+
+
+def get_archive_cutoff():
+    """Return the start_time ("YYYY-MM-01T00:00") before which events are archived, or None"""
+    try:
+        return _archive_cutoff["before"]
+    except KeyError:
+        pass
+    meta = get_backend().get(META_COLLECTION, ARCHIVE_COLLECTION) or {}
+    cutoff = f"{meta['before']}-01T00:00" if meta.get("before") else None
+    _archive_cutoff["before"] = cutoff
+    return cutoff
+
+
+def _event_partitions(start, end):
+    """[(collections, start, end)] holding the events with start_time in [start, end)"""
+    cutoff = get_archive_cutoff()
+    if not cutoff or start >= cutoff:
+        return [(("events",), start, end)]
+    partitions = [((ARCHIVE_COLLECTION, "events"), start, min(end, cutoff))]
+    if end > cutoff:
+        partitions.append((("events",), cutoff, end))
+    return partitions
+
+
+def _query_partition(collection_names, start, end, **kwargs):
+    """Events of [start, end) from one or more collections, merged by start_time"""
+    queries = [
+        get_backend().query(
+            collection_name,
+            filters=[("start_time", ">=", start), ("start_time", "<", end)],
+            order_by="start_time",
+            **kwargs,
+        )
+        for collection_name in collection_names
+    ]
+    if len(queries) == 1:
+        return queries[0]
+    return heapq.merge(*queries, key=lambda event: (event["start_time"], event["id"]))
+
+
+def get_events_between(start, end):
+    """Stream events with start_time in [start, end) ordered by start_time"""
+    for collection_names, part_start, part_end in _event_partitions(start, end):
+        yield from _query_partition(collection_names, part_start, part_end)
+
+
+def get_events_page(start, end, cursor=None, limit=100, fields=None):
+    """Return a page of events with start_time in [start, end) and the next cursor"""
+    start_after = None
+    if cursor:
+        # El cursor es "start_time|id" del último documento de la página anterior
+        start_after = tuple(cursor.split("|", 1))
+
+    events = []
+    for collection_names, part_start, part_end in _event_partitions(start, end):
+        if start_after and start_after[0] >= part_end:
+            continue  # el cursor ya pasó por esta parte
+        remaining = limit - len(events)
+        events.extend(
+            islice(
+                _query_partition(
+                    collection_names,
+                    part_start,
+                    part_end,
+                    start_after=start_after if start_after and start_after[0] >= part_start else None,
+                    limit=remaining,
+                    fields=fields,
+                ),
+                remaining,
+            )
+        )
+        if len(events) == limit:
+            break
+
+    next_cursor = None
+    if len(events) == limit:
+        next_cursor = f"{events[-1]['start_time']}|{events[-1]['id']}"
+    return events, next_cursor
+
+
+def iter_events_paged(start, end, page_size=BATCH_LIMIT, fields=None):
+    """Yield events with start_time in [start, end) one page query at a time
+
+    Memory stays at one page no matter how long the range is.
+    """
+    cursor = None
+    while True:
+        events, cursor = get_events_page(start, end, cursor=cursor, limit=page_size, fields=fields)
+        yield from events
+        if cursor is None:
+            return
+
+
+def archive_events(before_year=None):
+    """Move the events before January 1st of `before_year` to the archive and return how many
+
+    By default the current year and the ARCHIVE_KEEP_YEARS before it stay.
+    Events are moved in batches (copy + delete in the same atomic batch), so
+    an interrupted run can simply be repeated. Stats counters are kept.
+    """
+    if before_year is None:
+        before_year = datetime.now().year - ARCHIVE_KEEP_YEARS
+    before = f"{before_year:04d}-01"
+    backend = get_backend()
+
+    # Primero el corte: las lecturas ya buscan en el archivo mientras se mueve
+    meta = backend.get(META_COLLECTION, ARCHIVE_COLLECTION) or {}
+    if before > meta.get("before", ""):
+        backend.batch_write([("merge", META_COLLECTION, ARCHIVE_COLLECTION, {"before": before})])
+    _archive_cutoff.clear()
+    cutoff = get_archive_cutoff()
+
+    moved = 0
+    while True:
+        events = list(
+            backend.query(
+                "events",
+                filters=[("start_time", "<", cutoff)],
+                order_by="start_time",
+                limit=ARCHIVE_BATCH,
+            )
+        )
+        if not events:
+            break
+        operations = []
+        for event in events:
+            data = {field: value for field, value in event.items() if field != "id"}
+            operations.append(("set", ARCHIVE_COLLECTION, event["id"], data))
+            operations.append(("delete", "events", event["id"], None))
+        write_batch(operations)
+        moved += len(events)
+    return moved
+
+
+def get_booking_index(month):
+    """Return the BookingIndex of a month ("YYYY-MM"), loading it with one range query"""
+    with _booking_lock:
+        index = _booking_cache.get(month)
+    if index is None:
+        year, month_number = (int(part) for part in month.split("-"))
+        start = f"{month}-01T00:00"
+        end = (
+            f"{year + 1}-01-01T00:00"
+            if month_number == 12
+            else f"{year}-{month_number + 1:02d}-01T00:00"
+        )
+        index = BookingIndex(
+            get_backend().query(
+                "events",
+                filters=[("start_time", ">=", start), ("start_time", "<", end)],
+                order_by="start_time",
+                fields=BOOKING_FIELDS,
+            )
+        )
+        with _booking_lock:
+            _booking_cache[month] = index
+    return index
+
+
+def find_conflicts(event):
+    """Return [(dimension, existing event)] booked at an overlapping time"""
+    conflicts = {}
+    for month in booking_months(event):
+        index = get_booking_index(month)
+        # Con el lock: _update_booking_cache agrega eventos al mismo índice
+        with _booking_lock:
+            found = index.conflicts(event)
+        # Un evento cerca de fin de mes está en el índice de ambos meses
+        for dimension, other in found:
+            conflicts.setdefault((dimension, other["id"]), (dimension, other))
+    return list(conflicts.values())
+
+
+def _update_booking_cache(changes, ids):
+    with _booking_lock:
+        for (old, new), doc_id in zip(changes, ids):
+            if old is None and new is not None:
+                # Evento nuevo: se agrega a los meses ya cargados
+                event = {**new, "id": doc_id}
+                for month in booking_months(event):
+                    index = _booking_cache.get(month)
+                    if index is not None:
+                        index.add(event)
+            else:
+                for event in (old, new):
+                    for month in booking_months(event or {}):
+                        _booking_cache.pop(month, None)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+def sync_token():
+    """Token for get_event_changes(since=...) covering every change from now on"""
+    return (datetime.now(timezone.utc) - SYNC_OVERLAP).isoformat(timespec="microseconds")
+
+
+def sync_expired(since):
+    """True if `since` is older than the kept tombstones (a full sync is needed)"""
+    limit = datetime.now(timezone.utc) - DELETED_EVENTS_RETENTION
+    return since < limit.isoformat(timespec="microseconds")
+
+
+def prune_deleted_events():
+    """Delete tombstones older than DELETED_EVENTS_RETENTION (one batch) and return how many"""
+    limit = (datetime.now(timezone.utc) - DELETED_EVENTS_RETENTION).isoformat(timespec="microseconds")
+    backend = get_backend()
+    operations = [
+        ("delete", DELETED_EVENTS_COLLECTION, doc["id"], None)
+        for doc in backend.query(
+            DELETED_EVENTS_COLLECTION,
+            filters=[("deleted_at", "<", limit)],
+            limit=BATCH_LIMIT,
+            fields=["deleted_at"],
+        )
+    ]
+    if operations:
+        backend.batch_write(operations)
+    return len(operations)
+
+
+def _maybe_prune_deleted_events():
+    global _last_prune
+    if time.monotonic() - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = time.monotonic()
+    try:
+        prune_deleted_events()
+    except Exception:
+        logger.exception("No se pudieron borrar las marcas de borrado viejas")
+
+
+def _sync_operations(operations):
+    """Agrega updated_at a las escrituras de eventos y una marca por cada borrado"""
+    now = _now()
     result = []
-    for doc in docs:
-        data = doc.to_dict()
-        data["id"] = doc.id
-        result.append(data)
+    for kind, collection_name, doc_id, data in operations:
+        if collection_name != "events":
+            result.append((kind, collection_name, doc_id, data))
+        elif kind == "delete":
+            result.append((kind, collection_name, doc_id, data))
+            result.append(("set", DELETED_EVENTS_COLLECTION, doc_id, {"deleted_at": now}))
+        elif kind == "increment":
+            result.append((kind, collection_name, doc_id, data))
+        else:
+            result.append((kind, collection_name, doc_id, {**data, "updated_at": now}))
     return result
 
 
+def get_event_changes(since=None, cursor=None, limit=500, fields=None):
+    """Return (events, deleted ids, next cursor) changed after `since`.
+
+    Without `since` every event is returned (paginated by id). Deleted ids
+    come with the last page only.
+    """
+    backend = get_backend()
+    start_after = None
+    if cursor:
+        # El cursor es "updated_at|id" (o solo el id sin `since`)
+        start_after = tuple(cursor.split("|", 1)) if since else (cursor, cursor)
+    if fields is not None:
+        fields = list(fields) + ["updated_at"]
+
+    if since:
+        events = list(
+            backend.query(
+                "events",
+                filters=[("updated_at", ">", since)],
+                order_by="updated_at",
+                start_after=start_after,
+                limit=limit,
+                fields=fields,
+            )
+        )
+    else:
+        events = list(
+            backend.query(
+                "events",
+                order_by="__name__",
+                start_after=start_after,
+                limit=limit,
+                fields=fields,
+            )
+        )
+
+    if len(events) == limit:
+        last = events[-1]
+        next_cursor = f"{last.get('updated_at', '')}|{last['id']}" if since else last["id"]
+        return events, [], next_cursor
+
+    deleted = []
+    if since:
+        markers = {
+            doc["id"]: doc["deleted_at"]
+            for doc in backend.query(
+                DELETED_EVENTS_COLLECTION,
+                filters=[("deleted_at", ">", since)],
+                fields=["deleted_at"],
+            )
+        }
+        # Un id borrado y vuelto a crear (ocurrencias recurrentes) sigue existiendo
+        current = get_records_by_ids([("events", doc_id) for doc_id in markers])
+        deleted = [
+            doc_id
+            for doc_id, deleted_at in markers.items()
+            if current.get(("events", doc_id), {}).get("updated_at", "") < deleted_at
+        ]
+    return events, deleted, None
+
+
+def write_batch(operations):
+    """Apply (kind, collection, id, data) writes in atomic batches and return the ids"""
+    synced = _sync_operations(operations)
+    written = get_backend().batch_write(synced)
+    ids = [
+        doc_id
+        for doc_id, operation in zip(written, synced)
+        if operation[1] != DELETED_EVENTS_COLLECTION
+    ]
+    for collection_name in {operation[1] for operation in operations}:
+        _after_write(collection_name)
+    return ids
+
+
+def write_events(operations, previous=None):
+    """Write event operations together with their stats counters and return the ids.
+
+    `previous` maps event id -> current document for the operations that
+    overwrite, update or delete existing events, so their old counters are
+    subtracted. Each batch carries the counter increments of its own events,
+    so events and stats are committed atomically. Deletes also leave their
+    marker in DELETED_EVENTS_COLLECTION. Archived events (ARCHIVE_COLLECTION)
+    can be written the same way.
+    """
+    previous = previous or {}
+    backend = get_backend()
+    ids = []
+    chunk, changes, months, territories = [], [], set(), set()
+    deletes = 0
+    stale_territories = set()
+
+    def flush():
+        territory_operations, stale = _territory_operations(changes)
+        synced = _sync_operations(chunk)
+        written = backend.batch_write(
+            synced + stats_operations(changes) + territory_operations
+        )
+        chunk_ids = [
+            doc_id
+            for doc_id, operation in zip(written, synced)
+            if operation[1] != DELETED_EVENTS_COLLECTION
+        ]
+        ids.extend(chunk_ids)
+        _update_booking_cache(changes, chunk_ids)
+        stale_territories.update(stale)
+
+    for kind, collection_name, doc_id, data in operations:
+        if collection_name not in ("events", ARCHIVE_COLLECTION):
+            raise ValueError(f"write_events solo escribe eventos, no {collection_name}")
+        old = previous.get(doc_id) if doc_id else None
+        if kind == "delete":
+            new = None
+        elif kind == "set":
+            new = data
+        else:
+            new = {**(old or {}), **data}
+
+        # Operaciones del lote (dos por borrado) + un increment por mes y dos
+        # por territorio <= BATCH_LIMIT
+        size = 2 if kind == "delete" else 1
+        touched_months = stats_months(old, new)
+        touched_territories = set(event_territories(old)) | set(event_territories(new))
+        new_months = months | touched_months
+        new_territories = territories | touched_territories
+        if chunk and (
+            len(chunk) + deletes + size + len(new_months) + 2 * len(new_territories)
+            > BATCH_LIMIT
+        ):
+            flush()
+            chunk, changes, deletes = [], [], 0
+            new_months, new_territories = touched_months, touched_territories
+        deletes += size - 1
+        chunk.append((kind, collection_name, doc_id, data))
+        changes.append((old, new))
+        months, territories = new_months, new_territories
+
+    if chunk:
+        flush()
+        if stale_territories:
+            _recompute_last_worked(stale_territories)
+        _after_write("events", bookings_updated=True)
+    return ids
+
+
+def _territory_operations(changes):
+    """Writes for territory_stats and the territories whose last event was removed
+
+    last_worked is raised with a "max" write, so concurrent writes for the
+    same territory keep the latest date whatever order they commit in.
+    """
+    worked, latest, removed = territory_changes(changes)
+    touched = set(latest) | set(removed)
+    current = get_records_by_ids(
+        [(TERRITORY_STATS_COLLECTION, territory_id) for territory_id in touched]
+    )
+
+    operations = [
+        ("increment", TERRITORY_STATS_COLLECTION, territory_id, {"times_worked": n})
+        for territory_id, n in worked.items()
+    ]
+    stale = set()
+    for territory_id in touched:
+        stats = current.get((TERRITORY_STATS_COLLECTION, territory_id)) or {}
+        last_worked = stats.get("last_worked") or ""
+        newest = latest.get(territory_id, "")
+        if last_worked in removed.get(territory_id, ()) and newest < last_worked:
+            # Se quitó el evento más reciente: se busca el anterior después de escribir
+            stale.add(territory_id)
+        elif newest > last_worked:
+            # "max" y no "merge": otra escritura pudo subirlo desde la lectura
+            operations.append(
+                ("max", TERRITORY_STATS_COLLECTION, territory_id, {"last_worked": newest})
+            )
+    return operations, stale
+
+
+def _recompute_last_worked(territory_ids):
+    """Look up the latest remaining event of each territory (one query per territory)
+
+    The query needs the composite index in firestore.indexes.json. If it
+    fails, the events are already written: the territory is marked with
+    `last_worked_stale` for backfill-stats to repair instead of failing the
+    request.
+    """
+    backend = get_backend()
+    operations = []
+    for territory_id in territory_ids:
+        latest = None
+        try:
+            # Si no queda ningún evento vigente, el último puede estar archivado
+            for collection_name in ("events", ARCHIVE_COLLECTION):
+                latest = next(
+                    iter(
+                        backend.query(
+                            collection_name,
+                            filters=[("territory_ids", "array_contains", territory_id)],
+                            order_by="start_time",
+                            descending=True,
+                            limit=1,
+                            fields=["start_time"],
+                        )
+                    ),
+                    None,
+                )
+                if latest is not None:
+                    break
+        except Exception:
+            logger.exception(
+                "No se pudo recalcular last_worked del territorio %s; ejecutar backfill-stats",
+                territory_id,
+            )
+            operations.append(
+                ("merge", TERRITORY_STATS_COLLECTION, territory_id, {"last_worked_stale": True})
+            )
+            continue
+        operations.append(
+            (
+                "merge",
+                TERRITORY_STATS_COLLECTION,
+                territory_id,
+                {"last_worked": latest["start_time"] if latest else None},
+            )
+        )
+    backend.batch_write(operations)
+
+
+def rebuild_stats():
+    """Recalculate every stats document from the events (one full pass) and return the months
+
+    Archived events count too. Legacy events that only have the joined
+    `territory_number` string get their `territory_ids` filled in from the
+    territory numbers.
+    """
+    backend = get_backend()
+    territory_by_number = {
+        str(territory.get("number")): territory["id"] for territory in get_cached("territories")
+    }
+
+    counters = {}
+    territory_stats = {}
+    legacy_updates = []
+    fields = [
+        "start_time",
+        "conductor_id",
+        "conductor_name",
+        "location_id",
+        "location_name",
+        "territory_ids",
+        "territory_number",
+    ]
+    events = (
+        (collection_name, event)
+        for collection_name in ("events", ARCHIVE_COLLECTION)
+        for event in backend.query(collection_name, fields=fields)
+    )
+    for collection_name, event in events:
+        if "territory_ids" not in event and event.get("territory_number"):
+            event["territory_ids"] = [
+                territory_by_number[number.strip()]
+                for number in str(event["territory_number"]).split(",")
+                if number.strip() in territory_by_number
+            ]
+            legacy_updates.append(
+                (
+                    "update",
+                    collection_name,
+                    event["id"],
+                    {"territory_ids": event["territory_ids"]},
+                )
+            )
+
+        month, event_fields = event_counters(event)
+        if month is None:
+            continue
+        month_counters = counters.setdefault(month, {})
+        for field, amount in event_fields.items():
+            month_counters[field] = month_counters.get(field, 0) + amount
+        for territory_id in event_territories(event):
+            stats = territory_stats.setdefault(
+                territory_id, {"times_worked": 0, "last_worked": None}
+            )
+            stats["times_worked"] += 1
+            if event["start_time"] > (stats["last_worked"] or ""):
+                stats["last_worked"] = event["start_time"]
+
+    operations = list(legacy_updates)
+    operations.extend(
+        ("set", STATS_COLLECTION, month, data) for month, data in sorted(counters.items())
+    )
+    operations.extend(
+        ("set", TERRITORY_STATS_COLLECTION, territory_id, data)
+        for territory_id, data in territory_stats.items()
+    )
+    # Documentos que ya no tienen eventos
+    operations.extend(
+        ("delete", STATS_COLLECTION, doc["id"], None)
+        for doc in backend.query(STATS_COLLECTION, fields=["total"])
+        if doc["id"] not in counters
+    )
+    operations.extend(
+        ("delete", TERRITORY_STATS_COLLECTION, doc["id"], None)
+        for doc in backend.query(TERRITORY_STATS_COLLECTION, fields=["times_worked"])
+        if doc["id"] not in territory_stats
+    )
+    if operations:
+        backend.batch_write(operations)
+    if legacy_updates:
+        _after_write("events")
+    return sorted(counters)
+
+
+def get_collection_version(collection_name):
+    """Return (version, updated_at) of a versioned collection; (0, None) if never written"""
+    meta = get_backend().get(META_COLLECTION, collection_name) or {}
+    return meta.get("version", 0), meta.get("updated_at")
+
+
+def bump_collection_version(collection_name):
+    """Mark a versioned collection as changed"""
+    get_backend().increment(
+        META_COLLECTION,
+        collection_name,
+        {"version": 1},
+        {"updated_at": datetime.now(timezone.utc).isoformat(timespec="seconds")},
+    )
+
+
+def add_write_listener(collection_name, callback):
+    """Call `callback()` after every write to a collection made by this process"""
+    _write_listeners.setdefault(collection_name, []).append(callback)
+
+
+def _after_write(collection_name, bookings_updated=False):
+    if collection_name == ARCHIVE_COLLECTION:
+        # Los meses archivados también se leen (PDF, ICS): cuenta como cambio de eventos
+        collection_name = "events"
+    invalidate_cache(collection_name)
+    if collection_name == "events" and not bookings_updated:
+        # Escritura de eventos fuera de write_events: se recarga el índice
+        with _booking_lock:
+            _booking_cache.clear()
+    if collection_name in VERSIONED_COLLECTIONS:
+        bump_collection_version(collection_name)
+    if collection_name == "events":
+        _maybe_prune_deleted_events()
+    for callback in _write_listeners.get(collection_name, ()):
+        callback()
+
+
 def add_record(collection_name, data):
-    """Add a new document to a collection"""
-    db.collection(collection_name).add(data)
+    """Add a new document to a collection and return its id"""
+    doc_id = get_backend().add(collection_name, data)
+    _after_write(collection_name)
+    return doc_id
+
+
+def update_record(collection_name, doc_id, data):
+    """Update fields of a document by id"""
+    get_backend().update(collection_name, doc_id, data)
+    _after_write(collection_name)
 
 
 def delete_record(collection_name, doc_id):
     """Delete a document by id"""
-    db.collection(collection_name).document(doc_id).delete()
+    get_backend().delete(collection_name, doc_id)
+    _after_write(collection_name)
@@ -0,0 +1,198 @@
+"""Escritor iCalendar (RFC 5545) mínimo y en streaming.
+
+Reemplaza a la librería `ics`: genera el texto directamente, con el escape y
+el plegado de líneas que pide el RFC, sin construir objetos Calendar en
+memoria. Las variantes Apple y Google salen de una sola pasada por los eventos.
+"""
+
+import tempfile
+from datetime import datetime, timezone
+
+from conflict_utils import EVENT_DURATION
+
+PRODID = "-//JW-Plan//Calendario//ES"
+FEED_VARIANTS = ("apple", "google")
+# Tamaño aproximado de cada fragmento que se entrega al ZIP
+CHUNK_SIZE = 64 * 1024
+
+
+def escape_text(value):
+    """Escapa un valor TEXT (RFC 5545 §3.3.11)."""
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def fold_line(line):
+    """Pliega una línea en fragmentos de 75 octetos (RFC 5545 §3.1).
+
+    No corta caracteres UTF-8 multibyte; las líneas de continuación empiezan
+    con un espacio. Devuelve la línea terminada en CRLF.
+    """
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+
+    parts = []
+    current = []
+    size = 0
+    limit = 75
+    for char in line:
+        char_size = len(char.encode("utf-8"))
+        if size + char_size > limit:
+            parts.append("".join(current))
+            current = []
+            size = 0
+            limit = 74  # el espacio inicial cuenta como un octeto
+        current.append(char)
+        size += char_size
+    parts.append("".join(current))
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def format_datetime(dt):
+    # Mismo formato que generaba la librería `ics` para fechas sin zona
+    return dt.strftime("%Y%m%dT%H%M%SZ")
+
+
+def calendar_header(extra_lines=()):
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:{PRODID}", *extra_lines]
+    return "".join(fold_line(line) for line in lines)
+
+
+def calendar_footer():
+    return fold_line("END:VCALENDAR")
+
+
+def _vevent(uid, dtstamp, start, summary, location=None, url=None, description=None):
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{dtstamp}",
+        f"DTSTART:{format_datetime(start)}",
+        f"DTEND:{format_datetime(start + EVENT_DURATION)}",
+        f"SUMMARY:{escape_text(summary)}",
+    ]
+    if location:
+        lines.append(f"LOCATION:{escape_text(location)}")
+    if url:
+        lines.append(f"URL:{url}")
+    if description:
+        lines.append(f"DESCRIPTION:{escape_text(description)}")
+    lines.append("END:VEVENT")
+    return "".join(fold_line(line) for line in lines)
+
+
+def event_to_vevents(event_data, dtstamp):
+    """Devuelve (VEVENT Apple, VEVENT Google) de un evento, o None si no tiene fecha válida."""
+    try:
+        start_time_dt = datetime.strptime(event_data.get("start_time"), "%Y-%m-%dT%H:%M")
+    except (ValueError, TypeError):
+        return None
+
+    uid = f"{event_data.get('id', start_time_dt.strftime('%Y%m%dT%H%M'))}@jw-plan"
+    summary = f"Predicación - {event_data.get('title', 'Sin título')}"
+    url = event_data.get("url")
+    if not (url and url.startswith("http")):
+        url = None
+
+    # Apple: ubicación = nombre del lugar, con la URL aparte
+    descripcion = []
+    if event_data.get("conductor_name"):
+        descripcion.append(f"Conductor: {event_data['conductor_name']}")
+    if event_data.get("territory_number"):
+        descripcion.append(f"Territorio: {event_data['territory_number']}")
+    apple = _vevent(
+        uid,
+        dtstamp,
+        start_time_dt,
+        summary,
+        location=event_data.get("location_name"),
+        url=url,
+        description="\n".join(descripcion),
+    )
+
+    # Google: ubicación = URL, y el lugar va en la descripción
+    descripcion_google = []
+    if event_data.get("location_name"):
+        descripcion_google.append(f"Lugar: {event_data['location_name']}")
+    descripcion_google.extend(descripcion)
+    google = _vevent(
+        uid,
+        dtstamp,
+        start_time_dt,
+        summary,
+        location=url,
+        description="\n".join(descripcion_google),
+    )
+    return apple, google
+
+
+def write_calendars(events):
+    """Genera las entradas (nombre, fragmentos) de los dos .ics para stream_zip.
+
+    Se recorre `events` una sola vez: el calendario Apple se entrega a medida
+    que se escribe y el de Google se guarda en un archivo temporal (en memoria
+    hasta 1 MB) que se envía después.
+    """
+    dtstamp = format_datetime(datetime.now(timezone.utc))
+    google_buffer = tempfile.SpooledTemporaryFile(
+        max_size=1024 * 1024, mode="w+", encoding="utf-8"
+    )
+
+    def apple_chunks():
+        pending = [calendar_header()]
+        pending_size = 0
+        google_buffer.write(calendar_header())
+        for event_data in events:
+            vevents = event_to_vevents(event_data, dtstamp)
+            if vevents is None:
+                continue
+            apple, google = vevents
+            pending.append(apple)
+            pending_size += len(apple)
+            google_buffer.write(google)
+            if pending_size >= CHUNK_SIZE:
+                yield "".join(pending).encode("utf-8")
+                pending = []
+                pending_size = 0
+        pending.append(calendar_footer())
+        google_buffer.write(calendar_footer())
+        yield "".join(pending).encode("utf-8")
+
+    def google_chunks():
+        try:
+            google_buffer.seek(0)
+            while True:
+                chunk = google_buffer.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk.encode("utf-8")
+        finally:
+            google_buffer.close()
+
+    yield "calendario_apple.ics", apple_chunks()
+    yield "calendario_google.ics", google_chunks()
+
+
+def write_feed(events, variant, dtstamp, name="JW-Plan"):
+    """Genera el texto de un calendario suscribible (una sola variante)."""
+    index = FEED_VARIANTS.index(variant)
+    yield calendar_header(
+        [
+            f"X-WR-CALNAME:{escape_text(name)}",
+            # Sugerencia de cada cuánto deben consultar los clientes
+            "REFRESH-INTERVAL;VALUE=DURATION:PT1H",
+            "X-PUBLISHED-TTL:PT1H",
+        ]
+    )
+    for event_data in events:
+        vevents = event_to_vevents(event_data, dtstamp)
+        if vevents is not None:
+            yield vevents[index]
+    yield calendar_footer()
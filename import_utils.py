@@ -0,0 +1,260 @@
+"""Importación masiva de eventos desde CSV o XLSX.
+
+Las filas se validan contra mapas en memoria de ubicaciones, conductores y
+territorios (por nombre / número), así que no hay lecturas por fila. El
+resultado es una lista de operaciones para `write_batch` y los errores por fila.
+Las filas que se superponen con un evento existente o con otra fila del mismo
+archivo (mismo conductor o ubicación) se rechazan como error.
+"""
+
+import csv
+import io
+import re
+import unicodedata
+from datetime import date, datetime, time
+
+from conflict_utils import BookingIndex, describe_conflict
+from firebase_utils import build_event_data
+
+# Máximo de filas por archivo
+MAX_IMPORT_ROWS = 5000
+
+# Encabezado normalizado -> campo
+COLUMN_ALIASES = {
+    "titulo": "title",
+    "title": "title",
+    "evento": "title",
+    "fecha": "date",
+    "date": "date",
+    "dia": "date",
+    "hora": "time",
+    "time": "time",
+    "inicio": "start_time",
+    "start_time": "start_time",
+    "fecha y hora": "start_time",
+    "ubicacion": "location",
+    "lugar": "location",
+    "location": "location",
+    "conductor": "conductor",
+    "territorios": "territories",
+    "territorio": "territories",
+    "territories": "territories",
+}
+
+DATETIME_FORMATS = (
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y %H:%M:%S",
+)
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y")
+TIME_FORMATS = ("%H:%M", "%H:%M:%S", "%I:%M %p")
+
+
+def normalize(value):
+    """Minúsculas, sin tildes y con espacios simples (para comparar nombres)."""
+    text = unicodedata.normalize("NFKD", str(value or ""))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(text.casefold().split())
+
+
+class ImportResult:
+    def __init__(self):
+        self.total_rows = 0
+        self.operations = []
+        self.errors = []
+
+    @property
+    def valid_rows(self):
+        return len(self.operations)
+
+
+def read_rows(filename, stream):
+    """Itera (número de fila, {campo: valor}) de un archivo CSV o XLSX."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        rows = _read_xlsx(stream)
+    elif filename.lower().endswith(".csv"):
+        rows = _read_csv(stream)
+    else:
+        raise ValueError("Formato no soportado: use un archivo .csv o .xlsx")
+
+    header = None
+    for row_number, values in rows:
+        if header is None:
+            header = [COLUMN_ALIASES.get(normalize(value)) for value in values]
+            if "title" not in header:
+                raise ValueError("No se encontró la columna 'Título' en el encabezado")
+            continue
+        if not any(value not in (None, "") for value in values):
+            continue  # fila vacía
+        yield row_number, {
+            field: value for field, value in zip(header, values) if field
+        }
+
+
+def _read_csv(stream):
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    for index, values in enumerate(csv.reader(text, dialect), start=1):
+        yield index, [value.strip() for value in values]
+
+
+def _read_xlsx(stream):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        for index, values in enumerate(sheet.iter_rows(values_only=True), start=1):
+            yield index, [
+                value.strip() if isinstance(value, str) else value for value in values
+            ]
+    finally:
+        workbook.close()
+
+
+def _parse_with(value, formats, parse):
+    for fmt in formats:
+        try:
+            return parse(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError
+
+
+def parse_start_time(row):
+    """Devuelve start_time como "YYYY-MM-DDTHH:MM" (formato del formulario)."""
+    value = row.get("start_time")
+    if value in (None, ""):
+        day = row.get("date")
+        hour = row.get("time")
+        if day in (None, "") or hour in (None, ""):
+            raise ValueError("Falta la fecha o la hora")
+
+        if isinstance(day, datetime):
+            day = day.date()
+        elif not isinstance(day, date):
+            day = _parse_with(str(day), DATE_FORMATS, lambda v, f: datetime.strptime(v, f).date())
+
+        if isinstance(hour, datetime):
+            hour = hour.time()
+        elif not isinstance(hour, time):
+            hour = _parse_with(str(hour), TIME_FORMATS, lambda v, f: datetime.strptime(v, f).time())
+
+        value = datetime.combine(day, hour)
+    elif not isinstance(value, datetime):
+        value = _parse_with(str(value), DATETIME_FORMATS, datetime.strptime)
+
+    return value.strftime("%Y-%m-%dT%H:%M")
+
+
+def _index_by(items, key):
+    """Mapa normalizado -> documento; los nombres repetidos quedan como ambiguos (None)."""
+    index = {}
+    for item in items:
+        name = normalize(item.get(key))
+        index[name] = None if name in index else item
+    return index
+
+
+def prepare_import(rows, reference, find_conflicts=None):
+    """Valida las filas y arma las operaciones de escritura.
+
+    `reference` tiene las listas de "locations", "conductors" y "territories".
+    `find_conflicts(evento)` devuelve las superposiciones con eventos ya
+    guardados (ver firebase_utils.find_conflicts).
+    Con más de MAX_IMPORT_ROWS filas lanza ValueError sin devolver operaciones.
+    """
+    locations = _index_by(reference["locations"], "name")
+    conductors = _index_by(reference["conductors"], "name")
+    territories = _index_by(reference["territories"], "number")
+
+    # Filas ya aceptadas, para detectar superposiciones dentro del archivo
+    accepted = BookingIndex()
+
+    result = ImportResult()
+    for row_number, row in rows:
+        result.total_rows += 1
+        if result.total_rows > MAX_IMPORT_ROWS:
+            # Se rechaza el archivo entero: nada de importaciones a medias
+            raise ValueError(
+                f"El archivo tiene más de {MAX_IMPORT_ROWS} filas; divídelo en partes"
+            )
+
+        problems = []
+
+        title = str(row.get("title") or "").strip()
+        if not title:
+            problems.append("Falta el título")
+
+        start_time = None
+        try:
+            start_time = parse_start_time(row)
+        except ValueError as e:
+            problems.append(str(e) or "Fecha u hora inválida")
+
+        location_data = None
+        if row.get("location") in (None, ""):
+            problems.append("Falta la ubicación")
+        else:
+            name = normalize(row["location"])
+            location_data = locations.get(name)
+            if location_data is None:
+                problems.append(
+                    f"Ubicación {'repetida' if name in locations else 'desconocida'}: {row['location']}"
+                )
+
+        conductor_data = None
+        if row.get("conductor") in (None, ""):
+            problems.append("Falta el conductor")
+        else:
+            name = normalize(row["conductor"])
+            conductor_data = conductors.get(name)
+            if conductor_data is None:
+                problems.append(
+                    f"Conductor {'repetido' if name in conductors else 'desconocido'}: {row['conductor']}"
+                )
+
+        territories_data = []
+        raw_territories = row.get("territories")
+        if isinstance(raw_territories, float) and raw_territories.is_integer():
+            raw_territories = int(raw_territories)  # celdas numéricas de Excel
+        for number in re.split(r"[,;\s]+", str(raw_territories or "")):
+            if not number:
+                continue
+            territory_data = territories.get(normalize(number))
+            if territory_data is None:
+                problems.append(f"Territorio desconocido: {number}")
+            else:
+                territories_data.append(territory_data)
+
+        if problems:
+            result.errors.append((row_number, "; ".join(problems)))
+            continue
+
+        data = build_event_data(
+            title, start_time, location_data, conductor_data, territories_data
+        )
+        conflicts = accepted.conflicts(data)
+        if find_conflicts is not None:
+            conflicts += find_conflicts(data)
+        if conflicts:
+            result.errors.append(
+                (
+                    row_number,
+                    "Superposición: "
+                    + "; ".join(describe_conflict(*conflict) for conflict in conflicts),
+                )
+            )
+            continue
+
+        accepted.add(data, f"fila-{row_number}")
+        result.operations.append(("set", "events", None, data))
+
+    return result
@@ -0,0 +1,202 @@
+"""Exportaciones pesadas (PDF, ZIP, ICS) en segundo plano.
+
+El request solo registra el trabajo y responde enseguida; un pool de hilos
+hace las lecturas, el render y la compresión, y escribe el resultado en
+EXPORT_DIR. La página consulta `/jobs/<id>` hasta que termina y descarga el
+archivo desde `/jobs/<id>/download`.
+
+El id del trabajo es un hash del tipo, los parámetros y la versión de la
+colección de eventos, y el estado se guarda en `_jobs/{id}`. El documento se
+toma con una creación atómica (solo si no existe), así los pedidos iguales,
+también desde otros workers de gunicorn, comparten un solo trabajo, y mientras
+no cambien los eventos se reutiliza el archivo ya generado.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from firebase_utils import get_collection_version
+from metrics import timed
+from propagation_utils import JOBS_COLLECTION
+from storage import BATCH_LIMIT, get_backend
+
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("EXPORT_DIR") or os.path.join(tempfile.gettempdir(), "jwplan-exports")
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+# Segundos que se conservan los archivos generados
+EXPORT_RETENTION = int(os.getenv("EXPORT_RETENTION", "3600"))
+# Un trabajo "running" sin terminar después de esto se considera perdido
+EXPORT_TIMEOUT = int(os.getenv("EXPORT_TIMEOUT", "600"))
+
+_export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+_submit_lock = threading.Lock()
+
+# tipo -> (parse(form) -> parámetros, run(parámetros, archivo) -> (nombre, mimetype))
+_exporters = {}
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _age(timestamp):
+    if not timestamp:
+        return float("inf")
+    return (datetime.now(timezone.utc) - datetime.fromisoformat(timestamp)).total_seconds()
+
+
+def register_exporter(kind, parse, run):
+    """Registra un tipo de exportación.
+
+    `parse(form)` valida el formulario y devuelve los parámetros (ValueError si
+    no son válidos); `run(parámetros, archivo)` escribe el resultado y devuelve
+    (nombre de descarga, mimetype).
+    """
+    _exporters[kind] = (parse, run)
+
+
+def export_path(job_id):
+    return os.path.join(EXPORT_DIR, job_id)
+
+
+def _job_id(kind, params):
+    version, _ = get_collection_version("events")
+    key = json.dumps([kind, params, version], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+
+
+def _is_reusable(job):
+    if job is None:
+        return False
+    if job.get("status") in ("pending", "running"):
+        return _age(job.get("updated_at")) < EXPORT_TIMEOUT
+    if job.get("status") == "done":
+        return os.path.exists(export_path(job["id"]))
+    return False  # con error se vuelve a intentar
+
+
+def submit_export(kind, form):
+    """Devuelve el trabajo (dict) para el pedido, creándolo si no hay uno igual."""
+    if kind not in _exporters:
+        raise ValueError(f"Exportación desconocida: {kind}")
+    parse, _ = _exporters[kind]
+    params = parse(form)
+    job_id = _job_id(kind, params)
+    backend = get_backend()
+
+    with _submit_lock:
+        current = backend.get(JOBS_COLLECTION, job_id)
+        if _is_reusable(current):
+            return current
+
+        attempt = (current or {}).get("attempt", 0) + 1
+        job = {
+            "kind": "export",
+            "export": kind,
+            "params": params,
+            "status": "pending",
+            "filename": None,
+            "mimetype": None,
+            "error": None,
+            "attempt": attempt,
+            "created_at": _now(),
+            "updated_at": _now(),
+        }
+        if current is None:
+            claimed = backend.create(JOBS_COLLECTION, job_id, job)
+        else:
+            # Reintento (error o trabajo perdido): lo ejecuta el worker que crea
+            # la marca del intento; la limpieza la borra como a los trabajos
+            claimed = backend.create(
+                JOBS_COLLECTION,
+                f"{job_id}-{attempt}",
+                {"kind": "export", "claim": job_id, "updated_at": _now()},
+            )
+            if claimed:
+                backend.batch_write([("set", JOBS_COLLECTION, job_id, job)])
+        if not claimed:
+            # Otro worker lo tomó: se devuelve su trabajo
+            return backend.get(JOBS_COLLECTION, job_id) or {**job, "id": job_id}
+        _export_executor.submit(run_export, job_id, kind, params)
+
+    _cleanup()
+    return {**job, "id": job_id}
+
+
+def get_export(job_id):
+    """Estado de un trabajo de exportación, o None si no existe."""
+    job = get_backend().get(JOBS_COLLECTION, job_id)
+    if job is None or job.get("kind") != "export":
+        return None
+    return job
+
+
+def run_export(job_id, kind, params):
+    backend = get_backend()
+
+    def save(**fields):
+        fields["updated_at"] = _now()
+        backend.batch_write([("merge", JOBS_COLLECTION, job_id, fields)])
+
+    _, run = _exporters[kind]
+    path = export_path(job_id)
+    # Nombre propio por ejecución: nunca dos escrituras sobre el mismo archivo
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        save(status="running")
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        with timed(f"job_{kind}"), open(temp_path, "wb") as file:
+            filename, mimetype = run(params, file)
+        os.replace(temp_path, path)
+        save(status="done", filename=filename, mimetype=mimetype)
+    except Exception as e:
+        logger.exception("Error en la exportación %s (%s)", job_id, kind)
+        save(status="error", error=str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _cleanup():
+    """Borra los archivos y los trabajos de más de EXPORT_RETENTION segundos."""
+    _cleanup_jobs()
+    try:
+        names = os.listdir(EXPORT_DIR)
+    except OSError:
+        return
+    limit = time.time() - EXPORT_RETENTION
+    for name in names:
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            continue
+
+
+def _cleanup_jobs():
+    # Índice compuesto (kind, updated_at) en firestore.indexes.json
+    limit = (datetime.now(timezone.utc) - timedelta(seconds=EXPORT_RETENTION)).isoformat(
+        timespec="seconds"
+    )
+    try:
+        backend = get_backend()
+        old_jobs = backend.query(
+            JOBS_COLLECTION,
+            filters=[("kind", "==", "export"), ("updated_at", "<", limit)],
+            limit=BATCH_LIMIT,
+            fields=["updated_at"],
+        )
+        operations = [("delete", JOBS_COLLECTION, job["id"], None) for job in old_jobs]
+        if operations:
+            backend.batch_write(operations)
+    except Exception:
+        logger.exception("Error al borrar trabajos de exportación viejos")
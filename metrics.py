@@ -0,0 +1,350 @@
+"""Métricas de la aplicación en formato de texto de Prometheus (/metrics).
+
+Por cada request se registra la latencia por ruta y los documentos leídos y
+escritos en el almacenamiento. Las lecturas se cuentan envolviendo el backend
+(`InstrumentedBackend`), así que cubren Firestore y SQLite por igual. También
+se miden las duraciones de render de PDF e ICS.
+
+Con SLOW_REQUEST_MS se registra en el log cada request más lento que ese
+umbral, con el detalle de las operaciones de almacenamiento que hizo.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+from storage import StorageBackend, get_backend, set_backend
+
+logger = logging.getLogger(__name__)
+
+# Umbral del log de requests lentos (ms); vacío = desactivado
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS") or 0)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DOCUMENT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+# Estadísticas del request en curso; se copian a los hilos de fetch_parallel
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(
+                    f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+                )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels, label_values, [("le", bound)])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, label_values, [("le", "+Inf")])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REQUESTS = Counter(
+    "jwplan_http_requests_total", "Requests atendidos.", ("route", "method", "status")
+)
+REQUEST_LATENCY = Histogram(
+    "jwplan_http_request_duration_seconds",
+    "Latencia de los requests por ruta.",
+    ("route", "method"),
+)
+DOCUMENTS_READ = Histogram(
+    "jwplan_request_documents_read",
+    "Documentos leídos del almacenamiento por request.",
+    ("route",),
+    DOCUMENT_BUCKETS,
+)
+DOCUMENTS_WRITTEN = Histogram(
+    "jwplan_request_documents_written",
+    "Documentos escritos en el almacenamiento por request.",
+    ("route",),
+    DOCUMENT_BUCKETS,
+)
+STORAGE_CALLS = Counter(
+    "jwplan_storage_calls_total",
+    "Llamadas al almacenamiento por ruta y operación.",
+    ("route", "operation"),
+)
+RENDER_DURATION = Histogram(
+    "jwplan_render_duration_seconds",
+    "Duración del render de PDF e ICS.",
+    ("kind",),
+)
+
+METRICS = (
+    REQUESTS,
+    REQUEST_LATENCY,
+    DOCUMENTS_READ,
+    DOCUMENTS_WRITTEN,
+    STORAGE_CALLS,
+    RENDER_DURATION,
+)
+
+
+class RequestStats:
+    """Lecturas, escrituras y llamadas al almacenamiento de un request."""
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        # operación -> [llamadas, documentos, segundos]
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, reads=0, writes=0, seconds=0.0):
+        with self._lock:
+            self.reads += reads
+            self.writes += writes
+            call = self.calls.setdefault(operation, [0, 0, 0.0])
+            call[0] += 1
+            call[1] += reads + writes
+            call[2] += seconds
+
+    def breakdown(self):
+        with self._lock:
+            return ", ".join(
+                f"{operation}: {count}x {docs} docs {seconds * 1000:.1f}ms"
+                for operation, (count, docs, seconds) in sorted(self.calls.items())
+            )
+
+
+def _record(operation, reads=0, writes=0, seconds=0.0):
+    stats = _current.get()
+    if stats is not None:
+        stats.record(operation, reads, writes, seconds)
+
+
+class InstrumentedBackend(StorageBackend):
+    """Envuelve un backend y anota cada operación en el request en curso."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def query(self, *args, **kwargs):
+        started = time.perf_counter()
+        count = 0
+        try:
+            for doc in self.inner.query(*args, **kwargs):
+                count += 1
+                yield doc
+        finally:
+            _record("query", reads=count, seconds=time.perf_counter() - started)
+
+    def get(self, collection, doc_id):
+        started = time.perf_counter()
+        result = self.inner.get(collection, doc_id)
+        # Firestore cobra la lectura aunque el documento no exista
+        _record("get", reads=1, seconds=time.perf_counter() - started)
+        return result
+
+    def get_many(self, keys):
+        started = time.perf_counter()
+        result = self.inner.get_many(keys)
+        _record("get_many", reads=len(keys), seconds=time.perf_counter() - started)
+        return result
+
+    def _write(self, operation, writes, method, *args):
+        started = time.perf_counter()
+        result = method(*args)
+        _record(operation, writes=writes, seconds=time.perf_counter() - started)
+        return result
+
+    def add(self, collection, data):
+        return self._write("add", 1, self.inner.add, collection, data)
+
+    def create(self, collection, doc_id, data):
+        return self._write("create", 1, self.inner.create, collection, doc_id, data)
+
+    def update(self, collection, doc_id, data):
+        return self._write("update", 1, self.inner.update, collection, doc_id, data)
+
+    def delete(self, collection, doc_id):
+        return self._write("delete", 1, self.inner.delete, collection, doc_id)
+
+    def increment(self, collection, doc_id, amounts, extra=None):
+        return self._write(
+            "increment", 1, self.inner.increment, collection, doc_id, amounts, extra
+        )
+
+    def batch_write(self, operations):
+        return self._write(
+            "batch_write", len(operations), self.inner.batch_write, operations
+        )
+
+    def watch(self, collection, callback):
+        return self.inner.watch(collection, callback)
+
+    def reference_id(self, value):
+        return self.inner.reference_id(value)
+
+
+@contextmanager
+def timed(kind):
+    """Mide la duración de un bloque en jwplan_render_duration_seconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        RENDER_DURATION.observe(time.perf_counter() - started, kind)
+
+
+def timed_iter(kind, iterable):
+    """Como timed(), para respuestas en streaming: mide hasta el último fragmento."""
+    started = time.perf_counter()
+    try:
+        yield from iterable
+    finally:
+        RENDER_DURATION.observe(time.perf_counter() - started, kind)
+
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule else "(sin ruta)"
+
+
+def _instrument_backend():
+    backend = get_backend()
+    if not isinstance(backend, InstrumentedBackend):
+        set_backend(InstrumentedBackend(backend))
+
+
+def _request_finisher(stats, started, status):
+    """Devuelve la función que registra las métricas del request al terminar."""
+    route = _route_label()
+    method = request.method
+    path = request.full_path.rstrip("?")
+
+    def finish():
+        elapsed = time.perf_counter() - started
+        REQUESTS.inc(route, method, status)
+        REQUEST_LATENCY.observe(elapsed, route, method)
+        DOCUMENTS_READ.observe(stats.reads, route)
+        DOCUMENTS_WRITTEN.observe(stats.writes, route)
+        for operation, (count, _, _) in list(stats.calls.items()):
+            STORAGE_CALLS.inc(route, operation, amount=count)
+
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            logger.warning(
+                "Request lento: %s %s %.1fms, %d leídos, %d escritos [%s]",
+                method,
+                path,
+                elapsed * 1000,
+                stats.reads,
+                stats.writes,
+                stats.breakdown(),
+            )
+
+    return finish
+
+
+def _stream_with_stats(iterable, stats, finish):
+    # El cuerpo se genera después del request: se vuelve a activar su contador
+    _current.set(stats)
+    try:
+        yield from iterable
+    finally:
+        _current.set(None)
+        finish()
+
+
+def init_app(app):
+    """Registra los hooks de medición y la ruta /metrics."""
+
+    @app.before_request
+    def start_request_metrics():
+        _instrument_backend()
+        g.metrics = RequestStats()
+        g.metrics_token = _current.set(g.metrics)
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        stats = g.get("metrics")
+        if stats is None:
+            return response
+        finish = _request_finisher(stats, g.metrics_started, response.status_code)
+        if response.is_streamed:
+            # Las descargas en streaming leen mientras se envían: se mide hasta el final
+            response.response = _stream_with_stats(response.response, stats, finish)
+        else:
+            finish()
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exc):
+        token = g.pop("metrics_token", None)
+        if token is not None:
+            _current.reset(token)
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        lines = []
+        for metric in METRICS:
+            lines.extend(metric.expose())
+        return Response(
+            "\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4"
+        )
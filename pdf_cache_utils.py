@@ -0,0 +1,177 @@
+"""Caché de los PDFs mensuales ya dibujados.
+
+Cada PDF se guarda con la clave (rango de meses, hash de sus eventos), así que
+un cambio en un mes no invalida los PDFs de los demás. Para no consultar los
+eventos en cada descarga, el hash de cada rango se recuerda por versión de la
+colección (`_meta/events`): mientras no haya escrituras, servir un PDF cuesta
+una lectura y el ETag permite responder 304.
+
+Los PDFs se guardan en memoria (LRU limitado a PDF_CACHE_MAX_BYTES) y, si se
+define PDF_CACHE_DIR, también en disco para sobrevivir reinicios. Después de
+cada escritura de eventos se vuelven a dibujar en segundo plano el mes actual
+y los siguientes (PDF_PRERENDER_MONTHS).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from cachetools import LRUCache
+
+from firebase_utils import add_write_listener, get_collection_version
+from pdf_utils import month_range
+from storage import on_backend_reset
+
+logger = logging.getLogger(__name__)
+
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR") or None
+# Meses a dibujar después de una escritura (0 = desactivado) y espera para
+# agrupar las escrituras seguidas (importaciones, materializaciones)
+PDF_PRERENDER_MONTHS = int(os.getenv("PDF_PRERENDER_MONTHS", "2"))
+PDF_PRERENDER_DELAY = float(os.getenv("PDF_PRERENDER_DELAY", "5"))
+
+_pdfs = LRUCache(maxsize=PDF_CACHE_MAX_BYTES, getsizeof=len)
+# (rango, versión de eventos) -> hash de los eventos del rango
+_digests = LRUCache(maxsize=256)
+_lock = threading.Lock()
+
+_prerender_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-prerender")
+_prerender_pending = threading.Event()
+
+
+def range_key(meses):
+    """"AAAA-MM" del primer mes, con "+N" si el rango tiene más meses."""
+    year, month = meses[0]
+    key = f"{year:04d}-{month:02d}"
+    return f"{key}+{len(meses) - 1}" if len(meses) > 1 else key
+
+
+def events_digest(events):
+    """Hash del contenido de los eventos (sin updated_at, que no se dibuja)."""
+    content = sorted(
+        (
+            {field: value for field, value in event.items() if field != "updated_at"}
+            for event in events
+        ),
+        key=lambda event: (str(event.get("start_time")), event.get("id", "")),
+    )
+    payload = json.dumps(content, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def lookup(meses, load_events):
+    """Devuelve (hash, eventos) del rango.
+
+    Si el hash ya se conoce para la versión actual no se consultan los
+    eventos y se devuelve None en su lugar.
+    """
+    version, _ = get_collection_version("events")
+    key = (range_key(meses), version)
+    with _lock:
+        digest = _digests.get(key)
+    if digest is not None:
+        return digest, None
+
+    events = load_events(meses)
+    digest = events_digest(events)
+    with _lock:
+        _digests[key] = digest
+    return digest, events
+
+
+def clear():
+    """Vacía la caché en memoria (el disco se conserva)."""
+    with _lock:
+        _pdfs.clear()
+        _digests.clear()
+
+
+# Otro backend puede tener otros eventos con la misma versión
+on_backend_reset(clear)
+
+
+def _path(key, digest):
+    return os.path.join(PDF_CACHE_DIR, f"{key}-{digest}.pdf")
+
+
+def _read_disk(key, digest):
+    try:
+        with open(_path(key, digest), "rb") as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def _write_disk(key, digest, pdf_bytes):
+    try:
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        path = _path(key, digest)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(pdf_bytes)
+        os.replace(temp_path, path)
+        # Las versiones anteriores del mismo rango ya no se van a pedir
+        for name in os.listdir(PDF_CACHE_DIR):
+            if name.startswith(f"{key}-") and name.endswith(".pdf") and name != os.path.basename(path):
+                os.remove(os.path.join(PDF_CACHE_DIR, name))
+    except OSError as e:
+        logger.warning("No se pudo guardar el PDF %s en disco: %s", key, e)
+
+
+def get_pdf(meses, digest, events, load_events, render):
+    """Bytes del PDF del rango: desde memoria, desde disco o dibujándolo.
+
+    `render(meses, eventos)` devuelve los bytes; `events` puede ser None si
+    lookup() no los consultó.
+    """
+    key = range_key(meses)
+    with _lock:
+        pdf_bytes = _pdfs.get((key, digest))
+    if pdf_bytes is not None:
+        return pdf_bytes
+
+    pdf_bytes = _read_disk(key, digest) if PDF_CACHE_DIR else None
+    if pdf_bytes is None:
+        if events is None:
+            events = load_events(meses)
+        pdf_bytes = render(meses, events)
+        if PDF_CACHE_DIR:
+            _write_disk(key, digest, pdf_bytes)
+
+    with _lock:
+        # Los PDFs más grandes que la caché completa no se guardan en memoria
+        if len(pdf_bytes) <= _pdfs.maxsize:
+            _pdfs[(key, digest)] = pdf_bytes
+    return pdf_bytes
+
+
+def _prerender(load_events, render):
+    time.sleep(PDF_PRERENDER_DELAY)
+    # Las escrituras que lleguen mientras se dibuja programan otra pasada
+    _prerender_pending.clear()
+    now = datetime.now()
+    for year, month in month_range(now.year, now.month, PDF_PRERENDER_MONTHS):
+        try:
+            digest, events = lookup([(year, month)], load_events)
+            get_pdf([(year, month)], digest, events, load_events, render)
+        except Exception:
+            logger.exception("Error al dibujar el PDF de %02d/%d", month, year)
+
+
+def start_prerender(load_events, render):
+    """Dibuja los próximos meses en segundo plano después de cada escritura de eventos."""
+    if PDF_PRERENDER_MONTHS <= 0:
+        return
+
+    def schedule():
+        if not _prerender_pending.is_set():
+            _prerender_pending.set()
+            _prerender_executor.submit(_prerender, load_events, render)
+
+    add_write_listener("events", schedule)
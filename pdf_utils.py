@@ -0,0 +1,328 @@
+import io
+import os
+import math
+import calendar
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+# ReportLab se importa al generar el primer PDF (tarda en cargar y la mayoría
+# de los requests no lo necesitan)
+
+# Puntos por pulgada (reportlab.lib.units.inch)
+inch = 72.0
+
+# --- Márgenes ---
+MARGIN_TOP = 0.7 * inch
+MARGIN_BOTTOM = 0.5 * inch
+MARGIN_SIDE = 0.5 * inch
+
+# --- Configuración general ---
+COLS = 7
+HEADER_HEIGHT = 25
+INTERLINEADO = 15
+ESPACIO_ENTRE_EVENTOS = 8
+CELL_HEIGHT = 210
+CELL_WIDTH = 270
+
+DIAS_SEMANA = [
+    "Lunes",
+    "Martes",
+    "Miércoles",
+    "Jueves",
+    "Viernes",
+    "Sábado",
+    "Domingo",
+]
+
+
+# --- Función para convertir hex a RGB ---
+def hex_to_rgb(hex_color):
+    hex_color = hex_color.lstrip("#")
+    return tuple(int(hex_color[i : i + 2], 16) / 255 for i in (0, 2, 4))
+
+
+# --- Colores suaves ---
+COLOR1 = hex_to_rgb("#B9DBFF")
+COLOR2 = hex_to_rgb("#CCE5FF")
+
+# --- Color de tag de ejemplo ---
+TAG_COLORS = {
+    "Viloma Cala Cala": hex_to_rgb("#FFDFAF"),
+}
+
+
+class TextMeasurer:
+    """Memoriza stringWidth: los mismos textos se repiten en todo el calendario."""
+
+    def __init__(self):
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+
+        self._string_width = stringWidth
+        self._widths = {}
+
+    def width(self, text, font, size):
+        key = (text, font, size)
+        w = self._widths.get(key)
+        if w is None:
+            w = self._widths[key] = self._string_width(text, font, size)
+        return w
+
+
+def bucket_events_by_day(events_data):
+    """Agrupa los eventos por fecha en una sola pasada."""
+    by_day = defaultdict(list)
+    for evento in events_data:
+        by_day[evento["start_time"].date()].append(evento)
+    return by_day
+
+
+def tag_color_for(titulo):
+    """Color del primer tag contenido en el título, o None."""
+    for tag, color in TAG_COLORS.items():
+        if tag in titulo:
+            return color
+    return None
+
+
+def month_range(year, month, count):
+    """Lista de (año, mes) para `count` meses consecutivos desde year/month."""
+    meses = []
+    for i in range(count):
+        y, m = divmod(month - 1 + i, 12)
+        meses.append((year + y, m + 1))
+    return meses
+
+
+def layout_month(year, month, events_by_day, measurer):
+    """Pasada de layout: calcula tamaño de página, celdas y textos de un mes."""
+    primer_dia = datetime(year, month, 1).date()
+    num_dias = calendar.monthrange(year, month)[1]
+    primer_weekday = primer_dia.weekday()
+
+    # --- Calcular filas necesarias ---
+    rows = math.ceil((num_dias + primer_weekday) / 7) + 1
+
+    # --- Calcular tamaño hoja ---
+    width = MARGIN_SIDE * 2 + CELL_WIDTH * COLS
+    height = MARGIN_TOP + MARGIN_BOTTOM + HEADER_HEIGHT + CELL_HEIGHT * (rows - 1)
+
+    cells = []
+    for idx in range(num_dias):
+        dia_actual = primer_dia + timedelta(days=idx)
+        row = ((idx + primer_weekday) // COLS) + 1
+        x = MARGIN_SIDE + dia_actual.weekday() * CELL_WIDTH
+        y = height - MARGIN_TOP - HEADER_HEIGHT - row * CELL_HEIGHT
+
+        eventos_dia = events_by_day.get(dia_actual, ())
+
+        # --- Color de fondo: alternancia, o el tag del primer evento que tenga uno ---
+        color_fondo = COLOR1 if idx % 2 == 0 else COLOR2
+        for evento in eventos_dia:
+            color_tag = tag_color_for(evento.get("title", ""))
+            if color_tag:
+                color_fondo = color_tag
+                break
+
+        # --- Textos de los eventos ---
+        textos = []
+        for idx_ev, evento in enumerate(eventos_dia):
+            hora_dt = evento["start_time"]
+
+            # Posición vertical basada en la hora
+            if 6 <= hora_dt.hour < 12:
+                y_base = y + CELL_HEIGHT * 0.75 + 24
+            elif 12 <= hora_dt.hour < 18:
+                y_base = y + CELL_HEIGHT * 0.5 + 21
+            else:
+                y_base = y + CELL_HEIGHT * 0.25 + 18
+
+            y_text = y_base - idx_ev * ESPACIO_ENTRE_EVENTOS
+
+            # Título y hora en negrita
+            titulo = evento.get("title", "")
+            if titulo:
+                texto = f"{hora_dt.strftime('%H:%M')} - {titulo}"
+                x_centrado = (
+                    x + (CELL_WIDTH - measurer.width(texto, "Helvetica-Bold", 13)) / 2
+                )
+                textos.append(("Helvetica-Bold", 16, x_centrado, y_text, texto, None))
+                y_text -= INTERLINEADO
+
+            # Atributos del evento
+            atributos = {
+                "Conductor": evento.get("conductor_name"),
+                "Ubicación": evento.get("location_name"),
+                "Territorio": f"{evento.get('territory_number')}"
+                if evento.get("territory_number")
+                else None,
+            }
+
+            for col_name, valor in atributos.items():
+                if valor:
+                    texto_attr = f"{col_name}: {valor}"
+                    x_centrado = (
+                        x
+                        + (CELL_WIDTH - measurer.width(texto_attr, "Helvetica", 13))
+                        / 2
+                    )
+
+                    # URL clicable para la ubicación
+                    link = None
+                    if col_name == "Ubicación" and evento.get("url"):
+                        link = (
+                            evento["url"],
+                            (
+                                x_centrado,
+                                y_text,
+                                x_centrado
+                                + measurer.width(texto_attr, "Helvetica", 12),
+                                y_text + 12,
+                            ),
+                        )
+
+                    textos.append(("Helvetica", 14, x_centrado, y_text, texto_attr, link))
+                    y_text -= INTERLINEADO
+
+            y_text -= ESPACIO_ENTRE_EVENTOS
+
+        cells.append((x, y, color_fondo, dia_actual.day, textos))
+
+    return {
+        "size": (width, height),
+        "title": f"Calendario {primer_dia.strftime('%B %Y').capitalize()}",
+        "cells": cells,
+    }
+
+
+def draw_month(c, page):
+    """Pasada de dibujo: pinta en el canvas una página calculada por layout_month."""
+    width, height = page["size"]
+    c.setPageSize(page["size"])
+
+    # --- Título centrado ---
+    c.setFont("Helvetica-Bold", 28)
+    c.drawCentredString(width / 2, height - MARGIN_TOP / 2, page["title"])
+
+    # --- Cabecera de días ---
+    c.setFont("Helvetica-Bold", 18)
+    for i, dia in enumerate(DIAS_SEMANA):
+        x = MARGIN_SIDE + i * CELL_WIDTH
+        y = height - MARGIN_TOP - HEADER_HEIGHT
+        c.setFillColorRGB(0.85, 0.85, 0.85)
+        c.rect(x, y, CELL_WIDTH, HEADER_HEIGHT, fill=1, stroke=0)
+        c.setFillColorRGB(0, 0, 0)
+        c.drawCentredString(x + CELL_WIDTH / 2, y + 7, dia)
+
+    # --- Leyenda de tags ---
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(
+        MARGIN_SIDE, height - MARGIN_TOP - HEADER_HEIGHT - 20, "Leyenda de Tags:"
+    )
+    y_leyenda = height - MARGIN_TOP - HEADER_HEIGHT - 40
+    for tag, color in TAG_COLORS.items():
+        c.setFillColorRGB(*color)
+        c.rect(MARGIN_SIDE, y_leyenda, 50, 15, fill=1, stroke=0)
+        c.setFillColorRGB(0, 0, 0)
+        c.drawString(MARGIN_SIDE + 55, y_leyenda, tag)
+        y_leyenda -= 20
+
+    # --- Grilla de días ---
+    for x, y, color_fondo, numero_dia, textos in page["cells"]:
+        # Dibujar celda
+        c.setFillColorRGB(*color_fondo)
+        c.rect(x, y, CELL_WIDTH, CELL_HEIGHT, fill=1, stroke=0)
+        c.setFillColorRGB(0, 0, 0)
+        c.rect(x, y, CELL_WIDTH, CELL_HEIGHT)
+
+        # Número del día
+        c.setFont("Helvetica-Bold", 18)
+        c.drawString(x + 2, y + CELL_HEIGHT - 16, str(numero_dia))
+
+        # --- Dibujar eventos ---
+        for font, size, x_text, y_text, texto, link in textos:
+            c.setFont(font, size)
+            c.drawString(x_text, y_text, texto)
+            if link:
+                c.linkURL(*link)
+
+    c.showPage()
+
+
+def generate_calendar_pdf(months, events_data):
+    """Genera un PDF con una página por cada (año, mes) de `months`.
+
+    Los eventos se agrupan por día una sola vez, así que el costo es lineal en
+    días + eventos sin importar cuántos meses se impriman.
+    """
+    from reportlab.pdfgen import canvas
+
+    events_by_day = bucket_events_by_day(events_data)
+    measurer = TextMeasurer()
+
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer)
+    for year, month in months:
+        draw_month(c, layout_month(year, month, events_by_day, measurer))
+    c.save()
+    buffer.seek(0)
+    return buffer
+
+
+def generate_pdf_from_firestore(year, month, events_data):
+    """Genera un PDF del calendario a partir de los datos de Firestore."""
+    return generate_calendar_pdf([(year, month)], events_data)
+
+
+# --- Render en paralelo ---
+# ReportLab es CPU-bound y no libera el GIL, así que los meses de un lote se
+# dibujan en procesos aparte. El pool se crea la primera vez y se reutiliza.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # "spawn" evita heredar hilos y conexiones del servidor web
+                _pool = ProcessPoolExecutor(
+                    max_workers=PDF_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _pool
+
+
+def render_month_pdf(year, month, events_data):
+    """Devuelve los bytes del PDF de un mes (se ejecuta en el pool)."""
+    return generate_pdf_from_firestore(year, month, events_data).getvalue()
+
+
+def render_months_parallel(months, events_data):
+    """Genera (año, mes, bytes del PDF) a medida que cada mes termina.
+
+    Los eventos se reparten por mes antes de enviarlos, así cada proceso recibe
+    solo los suyos.
+    """
+    by_month = defaultdict(list)
+    for evento in events_data:
+        by_month[(evento["start_time"].year, evento["start_time"].month)].append(
+            evento
+        )
+
+    pool = _get_pool()
+    futures = {
+        pool.submit(render_month_pdf, year, month, by_month.get((year, month), [])): (
+            year,
+            month,
+        )
+        for year, month in months
+    }
+    for future in as_completed(futures):
+        year, month = futures[future]
+        yield year, month, future.result()
@@ -0,0 +1,211 @@
+"""Propagación de cambios de ubicaciones y conductores a los eventos.
+
+Los eventos guardan copias de los nombres (y la URL de la ubicación) para que
+las lecturas no tengan que unir colecciones. Cuando se edita una ubicación o un
+conductor, un trabajo en segundo plano busca los eventos afectados por el id
+guardado (`location_id` / `conductor_id`) y los reescribe en lotes, primero en
+`events` y después en el archivo de años anteriores.
+
+El progreso (fase, colección y cursor) se guarda en `_jobs/{id}` después de
+cada lote, así que un trabajo interrumpido continúa donde quedó al reiniciar la
+aplicación. Al terminar, el documento se borra: en `_jobs` solo quedan los
+trabajos pendientes o fallidos.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from firebase_utils import ARCHIVE_COLLECTION, get_record_by_id, write_batch, write_events
+from storage import BATCH_LIMIT, get_backend
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = "_jobs"
+
+# Colección -> (campo con el id en el evento, campo con el nombre, {campo origen: campo del evento})
+PROPAGATED_FIELDS = {
+    "locations": ("location_id", "location_name", {"name": "location_name", "url": "url"}),
+    "conductors": ("conductor_id", "conductor_name", {"name": "conductor_name"}),
+}
+
+# Pasos de un trabajo, en orden: (fase, colección de eventos)
+PROPAGATION_STEPS = (
+    ("id", "events"),
+    ("id", ARCHIVE_COLLECTION),
+    ("name", "events"),
+    ("name", ARCHIVE_COLLECTION),
+)
+# Un trabajo sin avances en este tiempo se considera abandonado (el worker
+# que lo ejecutaba se reinició) y se retoma
+PROPAGATION_TIMEOUT = int(os.getenv("PROPAGATION_TIMEOUT", "600"))
+
+# Estados de un trabajo sin terminar (los terminados se borran)
+UNFINISHED_STATUSES = ("pending", "running", "failed")
+
+# Un solo hilo: los trabajos se ejecutan en orden y no compiten entre sí
+_propagation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="propagation")
+_resume_lock = threading.Lock()
+_resumed = False
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _is_abandoned(job):
+    if job.get("status") == "failed":
+        return True
+    if not job.get("updated_at"):
+        return True
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(job["updated_at"])
+    return age.total_seconds() > PROPAGATION_TIMEOUT
+
+
+def start_propagation(collection_name, doc_id, old_name=None):
+    """Registra un trabajo de propagación para un documento y lo ejecuta en segundo plano.
+
+    `old_name` permite actualizar también los eventos anteriores a que se
+    guardara el id (se buscan por el nombre viejo y se les agrega el id).
+    Cada trabajo lee los valores actuales del documento en cada lote, así que
+    varios cambios seguidos solo repiten escrituras con el mismo resultado.
+    """
+    job_id = get_backend().add(
+        JOBS_COLLECTION,
+        {
+            "kind": "propagate",
+            "collection": collection_name,
+            "doc_id": doc_id,
+            "old_name": old_name,
+            "status": "pending",
+            "phase": "id",
+            "target": "events",
+            "cursor": None,
+            "updated": 0,
+            "error": None,
+            "created_at": _now(),
+            "updated_at": _now(),
+        },
+    )
+    _propagation_executor.submit(run_propagation, job_id)
+    return job_id
+
+
+def resume_propagation_jobs():
+    """Retoma en segundo plano los trabajos que no terminaron (una vez por proceso).
+
+    Los trabajos en curso solo se retoman si no avanzaron en
+    PROPAGATION_TIMEOUT segundos: con varios workers, otro puede estar
+    ejecutándolos.
+    """
+    global _resumed
+    with _resume_lock:
+        if _resumed:
+            return
+        _resumed = True
+
+    def resume():
+        try:
+            backend = get_backend()
+            for status in UNFINISHED_STATUSES:
+                jobs = backend.query(
+                    JOBS_COLLECTION,
+                    filters=[("kind", "==", "propagate"), ("status", "==", status)],
+                )
+                for job in jobs:
+                    if _is_abandoned(job):
+                        _propagation_executor.submit(run_propagation, job["id"])
+        except Exception:
+            logger.exception("Error al retomar trabajos de propagación")
+
+    _propagation_executor.submit(resume)
+
+
+def _matching_events(phase, target, id_field, name_field, doc_id, old_name, cursor):
+    """Una página de eventos afectados (solo los campos de referencia y la fecha)."""
+    if phase == "id":
+        filters = [(id_field, "==", doc_id)]
+    else:
+        filters = [(name_field, "==", old_name)]
+    return list(
+        get_backend().query(
+            target,
+            filters=filters,
+            order_by="__name__",
+            start_after=(cursor, cursor) if cursor else None,
+            limit=BATCH_LIMIT,
+            fields=[id_field, name_field, "start_time"],
+        )
+    )
+
+
+def run_propagation(job_id):
+    """Ejecuta (o continúa) un trabajo de propagación; devuelve los eventos actualizados."""
+    backend = get_backend()
+    job = backend.get(JOBS_COLLECTION, job_id)
+    if job is None or job.get("status") == "done":
+        return 0
+
+    collection_name = job["collection"]
+    doc_id = job["doc_id"]
+    id_field, name_field, field_map = PROPAGATED_FIELDS[collection_name]
+    phase = job.get("phase", "id")
+    target = job.get("target", "events")
+    cursor = job.get("cursor")
+    updated = job.get("updated", 0)
+
+    def save(**fields):
+        fields["updated_at"] = _now()
+        backend.batch_write([("merge", JOBS_COLLECTION, job_id, fields)])
+
+    try:
+        save(status="running")
+        while True:
+            source = get_record_by_id(collection_name, doc_id)
+            if source is None:
+                break  # el documento fue eliminado; no hay nada que copiar
+            values = {
+                target: source.get(field, "N/A") for field, target in field_map.items()
+            }
+
+            if phase == "name" and not job.get("old_name"):
+                break
+
+            events = _matching_events(
+                phase, target, id_field, name_field, doc_id, job.get("old_name"), cursor
+            )
+            operations = []
+            for event in events:
+                if phase == "name":
+                    # Solo eventos antiguos, sin id guardado
+                    if event.get(id_field):
+                        continue
+                    operations.append(
+                        ("update", target, event["id"], {**values, id_field: doc_id})
+                    )
+                else:
+                    operations.append(("update", target, event["id"], values))
+            if operations and phase == "name":
+                # Al agregar el id, los contadores pasan del nombre al id
+                write_events(operations, {event["id"]: event for event in events})
+            elif operations:
+                write_batch(operations)
+            updated += len(operations)
+
+            if len(events) < BATCH_LIMIT:
+                step = PROPAGATION_STEPS.index((phase, target)) + 1
+                if step == len(PROPAGATION_STEPS):
+                    break
+                (phase, target), cursor = PROPAGATION_STEPS[step], None
+            else:
+                cursor = events[-1]["id"]
+            save(phase=phase, target=target, cursor=cursor, updated=updated)
+
+        backend.batch_write([("delete", JOBS_COLLECTION, job_id, None)])
+        logger.info("Propagación %s: %d eventos actualizados", job_id, updated)
+    except Exception as e:
+        save(status="failed", error=str(e))
+        logger.exception("Error en la propagación %s", job_id)
+    return updated
@@ -0,0 +1,100 @@
+"""Plantillas de eventos recurrentes ("todos los sábados 09:00 en X con Y").
+
+Una plantilla se materializa en `events` para un rango de fechas con
+escrituras en lote. Cada ocurrencia usa un id determinístico
+(`{plantilla}_{AAAAMMDDHHMM}`), así que volver a materializar el mismo rango
+sobrescribe los mismos documentos: no hay duplicados.
+
+Cada plantilla guarda `materialized_to`, la última fecha ya materializada.
+Solo las ocurrencias hasta esa fecha pueden existir y se leen antes de
+sobrescribirlas (para restar sus contadores); extender el rango hacia
+adelante no lee nada.
+"""
+
+from datetime import datetime, timedelta
+
+from conflict_utils import BookingIndex, describe_conflict
+from firebase_utils import build_event_data
+
+RECURRING_COLLECTION = "recurring_events"
+# Rango máximo que se materializa de una vez
+MAX_MATERIALIZE_DAYS = 366
+
+
+def occurrence_id(template_id, start):
+    """Id determinístico del evento de una plantilla en una fecha y hora."""
+    return f"{template_id}_{start.strftime('%Y%m%d%H%M')}"
+
+
+def may_exist(template, start_time):
+    """Si la ocurrencia de `start_time` ("AAAA-MM-DDTHH:MM") pudo crearse antes."""
+    if "materialized_to" not in template:
+        return True  # plantilla sin registro (anterior a materialized_to)
+    until = template["materialized_to"]
+    return until is not None and start_time[:10] <= until
+
+
+def template_occurrences(template, start_date, end_date):
+    """Fechas y horas de la plantilla entre start_date y end_date (inclusive)."""
+    hour = datetime.strptime(template["time"], "%H:%M").time()
+    weekday = int(template["weekday"])
+
+    day = start_date + timedelta(days=(weekday - start_date.weekday()) % 7)
+    while day <= end_date:
+        yield datetime.combine(day, hour)
+        day += timedelta(weeks=1)
+
+
+def prepare_materialization(templates, start_date, end_date, reference, find_conflicts=None):
+    """Arma las operaciones "set" de las ocurrencias de `templates`.
+
+    `reference` tiene los mapas id -> documento de "locations", "conductors" y
+    "territories" (desde la caché), así no hay lecturas por ocurrencia.
+    Las ocurrencias que se superponen con otro evento (ver
+    firebase_utils.find_conflicts) o con otra ocurrencia no se escriben.
+    Devuelve (operaciones, [(inicio, mensaje)] de las omitidas).
+    """
+    locations = reference["locations"]
+    conductors = reference["conductors"]
+    territories = reference["territories"]
+
+    # Ocurrencias ya aceptadas, para detectar superposiciones entre plantillas
+    accepted = BookingIndex()
+
+    operations = []
+    skipped = []
+    for template in templates:
+        territories_data = [
+            territories[terr_id]
+            for terr_id in template.get("territory_ids", [])
+            if terr_id in territories
+        ]
+        for start in template_occurrences(template, start_date, end_date):
+            data = build_event_data(
+                template["title"],
+                start.strftime("%Y-%m-%dT%H:%M"),
+                locations.get(template.get("location_id")),
+                conductors.get(template.get("conductor_id")),
+                territories_data,
+            )
+            data["recurring_id"] = template["id"]
+            doc_id = occurrence_id(template["id"], start)
+
+            # Con el id propio: la ocurrencia ya creada no choca consigo misma
+            candidate = {**data, "id": doc_id}
+            conflicts = accepted.conflicts(candidate)
+            if find_conflicts is not None:
+                conflicts += find_conflicts(candidate)
+            if conflicts:
+                skipped.append(
+                    (
+                        data["start_time"],
+                        f"{template['title']}: "
+                        + "; ".join(describe_conflict(*conflict) for conflict in conflicts),
+                    )
+                )
+                continue
+
+            accepted.add(data, doc_id)
+            operations.append(("set", "events", doc_id, data))
+    return operations, skipped
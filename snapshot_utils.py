@@ -0,0 +1,245 @@
+"""Copia en memoria de los eventos vigentes, en columnas.
+
+Los inicios se guardan como un arreglo NumPy `datetime64[m]` ordenado, los ids
+como cadenas de ancho fijo y los textos repetidos (título, ubicación,
+conductor...) como códigos enteros sobre una lista de valores únicos. Filtrar
+un mes es una búsqueda binaria (`searchsorted`) y un corte del arreglo; no se
+vuelve a consultar ni a parsear `start_time` en cada request.
+
+La copia se mantiene al día con la versión de la colección (`_meta/events`):
+si cambió, se aplican solo los cambios desde la última sincronización
+(firebase_utils.get_event_changes). Los rangos que tocan meses archivados se
+siguen consultando al almacenamiento.
+"""
+
+import os
+import threading
+
+import numpy as np
+
+from firebase_utils import (
+    get_archive_cutoff,
+    get_collection_version,
+    get_event_changes,
+    get_events_between,
+    get_events_page,
+    sync_expired,
+    sync_token,
+)
+from storage import get_backend
+
+# EVENT_SNAPSHOT=0 desactiva la copia (todas las lecturas van al almacenamiento)
+SNAPSHOT_ENABLED = os.getenv("EVENT_SNAPSHOT", "1") == "1"
+
+# Campos de texto que se guardan (lo que usan la interfaz, el PDF y el ICS)
+SNAPSHOT_FIELDS = ("title", "location_name", "conductor_name", "territory_number", "url")
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def _parse_start(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        start = np.datetime64(value, "m")
+    except ValueError:
+        return None
+    return None if np.isnat(start) else start
+
+
+class EventSnapshot:
+    """Eventos ordenados por (start_time, id) en arreglos paralelos."""
+
+    def __init__(self, ids, starts, codes, lookups, version, token, backend):
+        self.ids = ids
+        self.starts = starts
+        # campo -> arreglo de códigos; {valor: código}; lista de valores (índice = código)
+        self.codes = codes
+        self.lookups = lookups
+        self.texts = {field: list(lookups[field]) for field in SNAPSHOT_FIELDS}
+        self.version = version
+        self.token = token
+        self.backend = backend
+
+    @classmethod
+    def empty(cls, backend):
+        return cls(
+            np.array([], dtype=str),
+            np.array([], dtype="datetime64[m]"),
+            {field: np.array([], dtype=np.int32) for field in SNAPSHOT_FIELDS},
+            {field: {} for field in SNAPSHOT_FIELDS},
+            None,
+            None,
+            backend,
+        )
+
+    def apply(self, events, deleted, version, token):
+        """Nueva copia con los eventos cambiados reemplazados y los borrados quitados.
+
+        Solo los eventos nuevos pasan por Python; el resto son operaciones
+        sobre los arreglos (filtro, concatenación y orden).
+        """
+        changed = [event["id"] for event in events] + list(deleted)
+        keep = ~np.isin(self.ids, changed) if changed else slice(None)
+        rows = _event_rows(events)
+
+        ids = np.concatenate([self.ids[keep], np.array([row[0] for row in rows], dtype=str)])
+        starts = np.concatenate(
+            [self.starts[keep], np.array([row[1] for row in rows], dtype="datetime64[m]")]
+        )
+        codes = {}
+        lookups = {}
+        for field in SNAPSHOT_FIELDS:
+            # Cada texto distinto se guarda una sola vez
+            lookup = lookups[field] = dict(self.lookups[field])
+            new_codes = np.fromiter(
+                (lookup.setdefault(row[2].get(field), len(lookup)) for row in rows),
+                dtype=np.int32,
+                count=len(rows),
+            )
+            codes[field] = np.concatenate([self.codes[field][keep], new_codes])
+
+        order = np.lexsort((ids, starts))
+        return EventSnapshot(
+            ids[order],
+            starts[order],
+            {field: field_codes[order] for field, field_codes in codes.items()},
+            lookups,
+            version,
+            token,
+            self.backend,
+        )
+
+    def _bounds(self, start, end):
+        lo = np.searchsorted(self.starts, np.datetime64(start, "m"), side="left")
+        hi = np.searchsorted(self.starts, np.datetime64(end, "m"), side="left")
+        return int(lo), int(hi)
+
+    def events(self, lo, hi, parse=False):
+        """Eventos de las filas [lo, hi) como dicts.
+
+        Con `parse`, start_time es un datetime (como lo usa el PDF); si no, la
+        cadena "YYYY-MM-DDTHH:MM".
+        """
+        starts = self.starts[lo:hi]
+        if parse:
+            start_values = starts.tolist()
+        else:
+            start_values = np.datetime_as_string(starts, unit="m").tolist()
+        columns = {
+            field: [self.texts[field][code] for code in self.codes[field][lo:hi].tolist()]
+            for field in SNAPSHOT_FIELDS
+        }
+        return [
+            {
+                "id": doc_id,
+                "start_time": start_value,
+                **{field: columns[field][i] for field in SNAPSHOT_FIELDS if columns[field][i] is not None},
+            }
+            for i, (doc_id, start_value) in enumerate(zip(self.ids[lo:hi].tolist(), start_values))
+        ]
+
+    def events_between(self, start, end, parse=False):
+        return self.events(*self._bounds(start, end), parse=parse)
+
+    def page(self, start, end, cursor=None, limit=100, fields=None):
+        """Como firebase_utils.get_events_page, con el mismo formato de cursor.
+
+        Con `fields` devuelve solo esos campos (y el id), igual que la consulta.
+        """
+        lo, hi = self._bounds(start, end)
+        if cursor:
+            after_start, after_id = cursor.split("|", 1)
+            # Después del cursor: inicio posterior, o mismo inicio e id mayor
+            moment = np.datetime64(after_start, "m")
+            same_lo = int(np.searchsorted(self.starts, moment, side="left"))
+            same_hi = int(np.searchsorted(self.starts, moment, side="right"))
+            position = same_lo + int(np.searchsorted(self.ids[same_lo:same_hi], after_id, side="right"))
+            lo = max(lo, position)
+        page_hi = min(hi, lo + limit)
+        events = self.events(lo, page_hi)
+
+        next_cursor = None
+        if len(events) == limit:
+            next_cursor = f"{events[-1]['start_time']}|{events[-1]['id']}"
+        if fields is not None:
+            events = [
+                {"id": event["id"], **{field: event[field] for field in fields if field in event}}
+                for event in events
+            ]
+        return events, next_cursor
+
+
+def _event_rows(events):
+    rows = []
+    for event in events:
+        start = _parse_start(event.get("start_time"))
+        if start is None:
+            continue  # sin fecha válida no aparece en ninguna vista
+        rows.append((event["id"], start, event))
+    return rows
+
+
+def _read_changes(since):
+    """Todas las páginas de get_event_changes -> (eventos, ids borrados)."""
+    fields = ["start_time", *SNAPSHOT_FIELDS]
+    events, deleted, cursor = [], [], None
+    while True:
+        page, page_deleted, cursor = get_event_changes(since, cursor=cursor, fields=fields)
+        events.extend(page)
+        deleted.extend(page_deleted)
+        if cursor is None:
+            return events, deleted
+
+
+def get_snapshot():
+    """Copia al día con la versión actual de los eventos (una lectura si no cambió)."""
+    global _snapshot
+    version, _ = get_collection_version("events")
+    backend = get_backend()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version == version and snapshot.backend is backend:
+        return snapshot
+
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is not None and snapshot.version == version and snapshot.backend is backend:
+            return snapshot
+        token = sync_token()
+        if (
+            snapshot is None
+            or snapshot.backend is not backend
+            or (snapshot.token and sync_expired(snapshot.token))
+        ):
+            # Primera lectura (o copia más vieja que las marcas de borrado):
+            # todos los eventos vigentes
+            snapshot = EventSnapshot.empty(backend)
+        events, deleted = _read_changes(snapshot.token)
+        snapshot = snapshot.apply(events, deleted, version, token)
+        _snapshot = snapshot
+    return snapshot
+
+
+def _uses_snapshot(start):
+    cutoff = get_archive_cutoff()
+    return SNAPSHOT_ENABLED and not (cutoff and start < cutoff)
+
+
+def events_between(start, end, parse=False):
+    """Eventos con start_time en [start, end), ordenados; como get_events_between."""
+    if _uses_snapshot(start):
+        return get_snapshot().events_between(start, end, parse=parse)
+    events = list(get_events_between(start, end))
+    if parse:
+        events = [event for event in events if _parse_start(event.get("start_time")) is not None]
+        for event in events:
+            event["start_time"] = _parse_start(event["start_time"]).tolist()
+    return events
+
+
+def events_page(start, end, cursor=None, limit=100, fields=None):
+    """Página de eventos y cursor siguiente; como get_events_page."""
+    if _uses_snapshot(start):
+        return get_snapshot().page(start, end, cursor=cursor, limit=limit, fields=fields)
+    return get_events_page(start, end, cursor=cursor, limit=limit, fields=fields)
@@ -0,0 +1,242 @@
+// Service worker de JW-Plan: programa disponible al instante y sin conexión.
+//
+// Los eventos se guardan en IndexedDB. Cada vez que la página pide un mes a
+// /api/events, se traen solo los cambios desde la última sincronización
+// (/api/events/changes?since=...) y el mes se responde desde IndexedDB. Si la
+// red tarda o no está, se responde con lo guardado y la sincronización sigue
+// en segundo plano.
+//
+// Los eventos archivados (anteriores a `archived_before`) llegan como borrados
+// y no se guardan: esos meses se piden siempre al servidor.
+
+const PAGES_CACHE = "jwplan-pages-v2";
+const ASSETS_CACHE = "jwplan-assets-v1";
+const DB_NAME = "jwplan";
+const DB_VERSION = 1;
+// Espera máxima a la red antes de responder con los datos guardados (ms)
+const SYNC_TIMEOUT = 1500;
+// Páginas de solo lectura que se guardan para verlas sin conexión. Las rutas
+// GET que modifican datos (/events/delete/..., etc.) nunca se guardan.
+const CACHED_PAGES = [
+  "/",
+  "/events",
+  "/locations",
+  "/conductors",
+  "/territories",
+  "/territories/coverage",
+  "/recurring",
+  "/stats",
+  "/pdf",
+  "/link",
+];
+
+self.addEventListener("install", () => self.skipWaiting());
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((keys) => Promise.all(
+        keys
+          .filter((key) => ![PAGES_CACHE, ASSETS_CACHE].includes(key))
+          .map((key) => caches.delete(key))
+      ))
+      .then(() => self.clients.claim())
+  );
+});
+
+// --- IndexedDB ---
+let dbPromise = null;
+
+function openDb() {
+  if (!dbPromise) {
+    dbPromise = new Promise((resolve, reject) => {
+      const request = indexedDB.open(DB_NAME, DB_VERSION);
+      request.onupgradeneeded = () => {
+        const db = request.result;
+        const events = db.createObjectStore("events", { keyPath: "id" });
+        events.createIndex("start_time", "start_time");
+        db.createObjectStore("meta");
+      };
+      request.onsuccess = () => resolve(request.result);
+      request.onerror = () => {
+        dbPromise = null;
+        reject(request.error);
+      };
+    });
+  }
+  return dbPromise;
+}
+
+function done(transaction) {
+  return new Promise((resolve, reject) => {
+    transaction.oncomplete = () => resolve();
+    transaction.onerror = () => reject(transaction.error);
+    transaction.onabort = () => reject(transaction.error);
+  });
+}
+
+function result(request) {
+  return new Promise((resolve, reject) => {
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+async function getSince() {
+  const db = await openDb();
+  return result(db.transaction("meta").objectStore("meta").get("since"));
+}
+
+async function getArchivedBefore() {
+  const db = await openDb();
+  return result(db.transaction("meta").objectStore("meta").get("archived_before"));
+}
+
+async function applyPage(page, since, first) {
+  const db = await openDb();
+  const transaction = db.transaction(["events", "meta"], "readwrite");
+  const events = transaction.objectStore("events");
+  if (page.reset && first) {
+    // Token más viejo que las marcas de borrado: llegan todos los eventos
+    events.clear();
+  }
+  page.events.forEach((item) => events.put(item));
+  page.deleted.forEach((id) => events.delete(id));
+  if (since) {
+    // Solo con la última página: una sincronización cortada se repite entera
+    const meta = transaction.objectStore("meta");
+    meta.put(since, "since");
+    meta.put(page.archived_before || null, "archived_before");
+  }
+  return done(transaction);
+}
+
+function monthStart(year, month) {
+  return `${year}-${String(month).padStart(2, "0")}-01T00:00`;
+}
+
+async function getMonth(year, month) {
+  const start = monthStart(year, month);
+  const end = month === 12
+    ? `${year + 1}-01-01T00:00`
+    : `${year}-${String(month + 1).padStart(2, "0")}-01T00:00`;
+  const db = await openDb();
+  const index = db.transaction("events").objectStore("events").index("start_time");
+  // El índice ya devuelve los eventos ordenados por start_time
+  return result(index.getAll(IDBKeyRange.bound(start, end, false, true)));
+}
+
+// --- Sincronización ---
+let syncing = null;
+
+async function sync() {
+  const since = await getSince();
+  let token = null;
+  let cursor = null;
+  do {
+    const params = new URLSearchParams();
+    if (since) params.set("since", since);
+    if (cursor) params.set("cursor", cursor);
+    const response = await fetch(`/api/events/changes?${params}`, { cache: "no-store" });
+    if (!response.ok) {
+      throw new Error(`Sincronización fallida: ${response.status}`);
+    }
+    const page = await response.json();
+    // El token de la primera página cubre los cambios hechos mientras se pagina
+    token = token || page.since;
+    cursor = page.next_cursor;
+    await applyPage(page, cursor ? null : token, !params.has("cursor"));
+  } while (cursor);
+}
+
+function syncOnce() {
+  // Los meses se piden en paralelo: una sola sincronización para todos
+  if (!syncing) {
+    syncing = sync().finally(() => {
+      syncing = null;
+    });
+  }
+  return syncing;
+}
+
+function timeout(ms) {
+  return new Promise((resolve) => setTimeout(() => resolve("timeout"), ms));
+}
+
+async function monthResponse(event, url) {
+  const year = Number(url.searchParams.get("year"));
+  const month = Number(url.searchParams.get("month"));
+  const synced = Boolean(await getSince().catch(() => null));
+  const pending = syncOnce();
+  event.waitUntil(pending.catch(() => null));
+
+  try {
+    if (synced) {
+      // Ya hay datos guardados: no se espera más de SYNC_TIMEOUT a la red
+      await Promise.race([pending.catch(() => null), timeout(SYNC_TIMEOUT)]);
+    } else {
+      await pending;
+    }
+    const archivedBefore = await getArchivedBefore();
+    if (archivedBefore && monthStart(year, month) < archivedBefore) {
+      // Mes archivado: no está en IndexedDB
+      return fetch(event.request);
+    }
+    const events = await getMonth(year, month);
+    return new Response(JSON.stringify({ events, next_cursor: null }), {
+      headers: { "Content-Type": "application/json" },
+    });
+  } catch (error) {
+    // Sin datos guardados ni red: se deja el request tal cual
+    return fetch(event.request);
+  }
+}
+
+// --- Páginas y recursos ---
+async function networkFirst(request) {
+  const cache = await caches.open(PAGES_CACHE);
+  try {
+    const response = await fetch(request);
+    if (response.ok) cache.put(request, response.clone());
+    return response;
+  } catch (error) {
+    const cached = await cache.match(request);
+    if (cached) return cached;
+    throw error;
+  }
+}
+
+async function staleWhileRevalidate(event) {
+  const cache = await caches.open(ASSETS_CACHE);
+  const cached = await cache.match(event.request);
+  const fresh = fetch(event.request).then((response) => {
+    if (response.ok || response.type === "opaque") {
+      cache.put(event.request, response.clone());
+    }
+    return response;
+  });
+  if (cached) {
+    event.waitUntil(fresh.catch(() => null));
+    return cached;
+  }
+  return fresh;
+}
+
+self.addEventListener("fetch", (event) => {
+  const request = event.request;
+  if (request.method !== "GET") return;
+  const url = new URL(request.url);
+
+  if (url.origin === self.location.origin) {
+    if (url.pathname === "/api/events" && !url.searchParams.has("cursor")) {
+      event.respondWith(monthResponse(event, url));
+    } else if (url.pathname.startsWith("/static/")) {
+      event.respondWith(staleWhileRevalidate(event));
+    } else if (request.mode === "navigate" && CACHED_PAGES.includes(url.pathname)) {
+      event.respondWith(networkFirst(request));
+    }
+  } else if (request.destination === "script" || request.destination === "style" || request.destination === "font") {
+    // Tailwind y Font Awesome desde el CDN
+    event.respondWith(staleWhileRevalidate(event));
+  }
+});
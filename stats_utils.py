@@ -0,0 +1,166 @@
+"""Estadísticas del programa con contadores pre-agregados.
+
+Cada mes tiene un documento `stats/{AAAA-MM}` con contadores planos:
+
+    {"total": 42, "conductor:<id>": 5, "location:<id>": 7, ...}
+
+Además, cada territorio tiene `territory_stats/{id}` con las veces que se
+trabajó y la fecha del último evento (`times_worked`, `last_worked`).
+
+Las escrituras de eventos suman y restan estos contadores en el mismo lote
+(ver firebase_utils.write_events), así que ver las estadísticas de un año
+cuesta 12 lecturas y las sugerencias de territorios una por territorio, sin
+importar cuántos eventos haya. Los eventos antiguos sin id de referencia se
+cuentan por nombre.
+"""
+
+import re
+
+STATS_COLLECTION = "stats"
+TERRITORY_STATS_COLLECTION = "territory_stats"
+
+# Dimensión -> (campo con el id, campo con el nombre)
+STATS_DIMENSIONS = {
+    "conductor": ("conductor_id", "conductor_name"),
+    "location": ("location_id", "location_name"),
+}
+
+_MONTH_RE = re.compile(r"^\d{4}-\d{2}")
+
+
+def month_key(event):
+    """"AAAA-MM" del evento, o None si no tiene start_time válido."""
+    start_time = (event or {}).get("start_time")
+    if isinstance(start_time, str) and _MONTH_RE.match(start_time):
+        return start_time[:7]
+    return None
+
+
+def event_counters(event):
+    """Devuelve (mes, {contador: 1}) de un evento; mes es None si no cuenta."""
+    month = month_key(event)
+    if month is None:
+        return None, {}
+    counters = {"total": 1}
+    for dimension, (id_field, name_field) in STATS_DIMENSIONS.items():
+        key = event.get(id_field) or event.get(name_field)
+        if key:
+            counters[f"{dimension}:{key}"] = 1
+    return month, counters
+
+
+def stats_deltas(changes):
+    """Suma los cambios (evento anterior, evento nuevo) en {mes: {contador: delta}}."""
+    deltas = {}
+    for old, new in changes:
+        for event, sign in ((old, -1), (new, 1)):
+            if event is None:
+                continue
+            month, counters = event_counters(event)
+            if month is None:
+                continue
+            month_deltas = deltas.setdefault(month, {})
+            for field, amount in counters.items():
+                month_deltas[field] = month_deltas.get(field, 0) + sign * amount
+
+    # Sin contadores en cero (por ejemplo, al renombrar sin cambiar de mes)
+    result = {}
+    for month, month_deltas in deltas.items():
+        month_deltas = {field: n for field, n in month_deltas.items() if n}
+        if month_deltas:
+            result[month] = month_deltas
+    return result
+
+
+def stats_operations(changes):
+    """Operaciones "increment" de los contadores afectados por `changes`."""
+    return [
+        ("increment", STATS_COLLECTION, month, month_deltas)
+        for month, month_deltas in sorted(stats_deltas(changes).items())
+    ]
+
+
+def stats_months(old, new):
+    """Meses cuyos contadores cambia un par (anterior, nuevo)."""
+    return {month for month in (month_key(old), month_key(new)) if month}
+
+
+def event_territories(event):
+    """Ids de territorio de un evento (vacío si no tiene fecha válida)."""
+    if month_key(event) is None:
+        return ()
+    return tuple(dict.fromkeys(event.get("territory_ids") or ()))
+
+
+def territory_changes(changes):
+    """Resume el efecto de (anterior, nuevo) sobre el índice de territorios.
+
+    Devuelve ({id: delta de times_worked}, {id: start_time más reciente
+    agregado}, {id: start_times quitados}).
+    """
+    worked = {}
+    latest = {}
+    removed = {}
+    for old, new in changes:
+        if old is not None:
+            for territory_id in event_territories(old):
+                worked[territory_id] = worked.get(territory_id, 0) - 1
+                removed.setdefault(territory_id, set()).add(old["start_time"])
+        if new is not None:
+            for territory_id in event_territories(new):
+                worked[territory_id] = worked.get(territory_id, 0) + 1
+                if new["start_time"] > latest.get(territory_id, ""):
+                    latest[territory_id] = new["start_time"]
+    return {tid: n for tid, n in worked.items() if n}, latest, removed
+
+
+def territory_suggestions(territories, territory_stats, limit=None):
+    """Territorios ordenados del menos al más recientemente trabajado.
+
+    Agrega `times_worked` y `last_worked` (None si nunca se trabajó) a cada
+    territorio; los que nunca se trabajaron van primero.
+    """
+    result = []
+    for territory in territories:
+        stats = territory_stats.get(territory["id"]) or {}
+        result.append(
+            {
+                **territory,
+                "times_worked": int(stats.get("times_worked", 0)),
+                "last_worked": stats.get("last_worked") or None,
+            }
+        )
+    result.sort(key=lambda t: (t["last_worked"] or "", t.get("number", 0)))
+    return result[:limit] if limit else result
+
+
+def summarize(month_docs, names):
+    """Arma las tablas del panel a partir de los documentos de cada mes.
+
+    `month_docs` es una lista de (mes, documento o None) en orden;
+    `names` tiene los mapas id -> nombre de "conductor" y "location".
+    Devuelve {"months", "totals", "conductor", "location"} donde cada
+    dimensión es una lista de (nombre, [conteo por mes], total) ordenada por total.
+    """
+    months = [month for month, _ in month_docs]
+    totals = [int((doc or {}).get("total", 0)) for _, doc in month_docs]
+
+    tables = {}
+    for dimension in STATS_DIMENSIONS:
+        prefix = f"{dimension}:"
+        rows = {}
+        for index, (_, doc) in enumerate(month_docs):
+            for field, count in (doc or {}).items():
+                if not field.startswith(prefix) or not count:
+                    continue
+                key = field[len(prefix):]
+                # Ids conocidos -> nombre actual; lo demás ya es un nombre
+                name = names[dimension].get(key, key)
+                row = rows.setdefault(name, [0] * len(months))
+                row[index] += int(count)
+        tables[dimension] = sorted(
+            ((name, counts, sum(counts)) for name, counts in rows.items()),
+            key=lambda row: (-row[2], row[0]),
+        )
+
+    return {"months": months, "totals": totals, **tables}
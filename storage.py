@@ -0,0 +1,568 @@
+"""Backends de almacenamiento.
+
+Las rutas no hablan con Firestore directamente: usan las operaciones de
+`StorageBackend` (a través de firebase_utils). Hay dos implementaciones:
+
+- `FirestoreBackend`: producción, con credenciales de Firebase.
+- `SQLiteBackend`: un archivo SQLite local con índices, sin credenciales ni
+  costo por lectura. Sirve para instalaciones pequeñas y para pruebas.
+
+Se elige con la variable de entorno STORAGE_BACKEND ("firestore" o "sqlite").
+Los documentos siempre se devuelven como dicts con la clave "id".
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+
+# Operadores de comparación soportados en los filtros de query()
+OPERATORS = ("==", "<", "<=", ">", ">=", "array_contains")
+
+# Máximo de operaciones por lote (límite de WriteBatch en Firestore)
+BATCH_LIMIT = 500
+
+
+class StorageBackend:
+    """Operaciones de datos que usan las rutas."""
+
+    def stream(self, collection, order_by=None):
+        """Itera todos los documentos de una colección."""
+        return self.query(collection, order_by=order_by)
+
+    def query(
+        self,
+        collection,
+        filters=(),
+        order_by=None,
+        start_after=None,
+        limit=None,
+        fields=None,
+        descending=False,
+    ):
+        """Itera los documentos que cumplen `filters`.
+
+        `filters` es una lista de (campo, operador, valor); "array_contains"
+        busca el valor dentro de un campo lista. Con `order_by` los resultados
+        se ordenan por ese campo y luego por id ("__name__" ordena solo por
+        id), de mayor a menor con `descending`; `start_after` es la tupla
+        (valor, id) del último documento de la página anterior.
+        """
+        raise NotImplementedError
+
+    def get(self, collection, doc_id):
+        """Devuelve un documento o None si no existe."""
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """Devuelve {(colección, id): documento} para los que existen."""
+        raise NotImplementedError
+
+    def add(self, collection, data):
+        """Crea un documento con id automático y devuelve el id."""
+        raise NotImplementedError
+
+    def create(self, collection, doc_id, data):
+        """Crea el documento solo si no existe; devuelve False si ya existía.
+
+        Es atómico entre procesos: sirve para que un solo worker tome un trabajo.
+        """
+        raise NotImplementedError
+
+    def update(self, collection, doc_id, data):
+        """Actualiza campos de un documento existente."""
+        raise NotImplementedError
+
+    def delete(self, collection, doc_id):
+        """Elimina un documento (no falla si no existe)."""
+        raise NotImplementedError
+
+    def increment(self, collection, doc_id, amounts, extra=None):
+        """Suma `amounts` ({campo: n}) de forma atómica y fija los campos de `extra`.
+
+        Crea el documento si no existe.
+        """
+        raise NotImplementedError
+
+    def batch_write(self, operations):
+        """Aplica escrituras en lotes atómicos de hasta BATCH_LIMIT operaciones.
+
+        Cada operación es (tipo, colección, id, datos) con tipo "set", "merge",
+        "update", "delete", "increment" (datos = {campo: n}) o "max" (cada
+        campo de datos queda en el mayor entre su valor actual y el nuevo, sin
+        carreras entre procesos). En "set" un id None genera uno nuevo.
+        Devuelve la lista de ids en el mismo orden.
+        """
+        raise NotImplementedError
+
+    def watch(self, collection, callback):
+        """Llama a `callback(documentos)` cuando cambia la colección.
+
+        Devuelve un objeto para cancelar la suscripción, o None si el backend
+        no soporta listeners.
+        """
+        return None
+
+    def reference_id(self, value):
+        """Id del documento si `value` es una referencia, si no None."""
+        return None
+
+
+class FirestoreBackend(StorageBackend):
+    def __init__(self, credentials_path=None):
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(
+                credentials_path
+                or os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+                or "key.json"
+            )
+            firebase_admin.initialize_app(cred)
+        self._firestore = firestore
+        self.db = firestore.client()
+
+    @staticmethod
+    def _to_dict(doc):
+        data = doc.to_dict()
+        data["id"] = doc.id
+        return data
+
+    def query(
+        self,
+        collection,
+        filters=(),
+        order_by=None,
+        start_after=None,
+        limit=None,
+        fields=None,
+        descending=False,
+    ):
+        query = self.db.collection(collection)
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        direction = "DESCENDING" if descending else "ASCENDING"
+        if order_by == "__name__":
+            # Orden solo por id (paginar sin un campo de orden)
+            query = query.order_by("__name__", direction=direction)
+            if start_after:
+                query = query.start_after({"__name__": start_after[1]})
+        elif order_by:
+            query = query.order_by(order_by, direction=direction).order_by(
+                "__name__", direction=direction
+            )
+            if start_after:
+                value, doc_id = start_after
+                query = query.start_after({order_by: value, "__name__": doc_id})
+        if fields:
+            query = query.select(fields)
+        if limit:
+            query = query.limit(limit)
+        for doc in query.stream():
+            yield self._to_dict(doc)
+
+    def get(self, collection, doc_id):
+        doc = self.db.collection(collection).document(doc_id).get()
+        if doc.exists:
+            return self._to_dict(doc)
+        return None
+
+    def get_many(self, keys):
+        refs = [self.db.collection(col).document(doc_id) for col, doc_id in keys]
+        if not refs:
+            return {}
+        result = {}
+        for doc in self.db.get_all(refs):
+            if doc.exists:
+                result[(doc.reference.parent.id, doc.id)] = self._to_dict(doc)
+        return result
+
+    def add(self, collection, data):
+        _, ref = self.db.collection(collection).add(data)
+        return ref.id
+
+    def create(self, collection, doc_id, data):
+        from google.api_core.exceptions import AlreadyExists
+
+        try:
+            self.db.collection(collection).document(doc_id).create(data)
+        except AlreadyExists:
+            return False
+        return True
+
+    def update(self, collection, doc_id, data):
+        self.db.collection(collection).document(doc_id).update(data)
+
+    def delete(self, collection, doc_id):
+        self.db.collection(collection).document(doc_id).delete()
+
+    def increment(self, collection, doc_id, amounts, extra=None):
+        data = {
+            field: self._firestore.Increment(amount)
+            for field, amount in amounts.items()
+        }
+        data.update(extra or {})
+        self.db.collection(collection).document(doc_id).set(data, merge=True)
+
+    def batch_write(self, operations):
+        ids = []
+        for i in range(0, len(operations), BATCH_LIMIT):
+            writes = []
+            for kind, collection, doc_id, data in operations[i : i + BATCH_LIMIT]:
+                col_ref = self.db.collection(collection)
+                ref = col_ref.document(doc_id) if doc_id else col_ref.document()
+                writes.append((kind, ref, data))
+                ids.append(ref.id)
+            if any(kind == "max" for kind, _, _ in writes):
+                # "max" necesita leer el valor actual: el lote va en una transacción
+                self._firestore.transactional(self._commit_max)(self.db.transaction(), writes)
+            else:
+                batch = self.db.batch()
+                for kind, ref, data in writes:
+                    self._add_write(batch, kind, ref, data)
+                batch.commit()
+        return ids
+
+    def _commit_max(self, transaction, writes):
+        refs = [ref for kind, ref, _ in writes if kind == "max"]
+        current = {doc.reference.path: doc.to_dict() or {} for doc in transaction.get_all(refs)}
+        for kind, ref, data in writes:
+            if kind == "max":
+                values = current.get(ref.path, {})
+                data = {
+                    field: value
+                    for field, value in data.items()
+                    if values.get(field) is None or value > values[field]
+                }
+                if data:
+                    transaction.set(ref, data, merge=True)
+            else:
+                self._add_write(transaction, kind, ref, data)
+
+    def _add_write(self, batch, kind, ref, data):
+        """Agrega una escritura a un WriteBatch o a una transacción."""
+        if kind == "set":
+            batch.set(ref, data)
+        elif kind == "merge":
+            batch.set(ref, data, merge=True)
+        elif kind == "update":
+            batch.update(ref, data)
+        elif kind == "delete":
+            batch.delete(ref)
+        elif kind == "increment":
+            batch.set(
+                ref,
+                {
+                    field: self._firestore.Increment(amount)
+                    for field, amount in data.items()
+                },
+                merge=True,
+            )
+        else:
+            raise ValueError(f"Operación desconocida: {kind}")
+
+    def watch(self, collection, callback):
+        def on_snapshot(col_snapshot, changes, read_time):
+            callback([self._to_dict(doc) for doc in col_snapshot])
+
+        return self.db.collection(collection).on_snapshot(on_snapshot)
+
+    def reference_id(self, value):
+        if isinstance(value, self._firestore.DocumentReference):
+            return value.id
+        return None
+
+
+class SQLiteBackend(StorageBackend):
+    """Guarda cada documento como JSON en una tabla con índices por campo."""
+
+    # Campos con índice de expresión; las consultas sobre ellos no recorren la tabla
+    INDEXED_FIELDS = (
+        "start_time",
+        "number",
+        "location_id",
+        "conductor_id",
+        "location_name",
+        "conductor_name",
+        "updated_at",
+    )
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("SQLITE_PATH", "jwplan.db")
+        self._local = threading.local()
+        self._uri = False
+        if self.path == ":memory:":
+            # Base en memoria compartida entre los hilos del proceso
+            self.path = f"file:jwplan-{uuid.uuid4().hex}?mode=memory&cache=shared"
+            self._uri = True
+            self._keepalive = self._connect()
+        self._create_schema()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, uri=self._uri, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if self._uri:
+            # Con caché compartida las lecturas bloquean la tabla y chocan con
+            # las escrituras de otros hilos ("database table is locked")
+            conn.execute("PRAGMA read_uncommitted = true")
+        else:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def conn(self):
+        # Una conexión por hilo
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """Transacción de escritura; IMMEDIATE evita carreras en lectura-modificación-escritura."""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _create_schema(self):
+        with self.conn as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    collection TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (collection, id)
+                ) WITHOUT ROWID
+                """
+            )
+            for field in self.INDEXED_FIELDS:
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_documents_{field} "
+                    f"ON documents (collection, {self._field_sql(field)}, id)"
+                )
+
+    @staticmethod
+    def _field_name(field):
+        if not field.replace("_", "").replace(".", "").isalnum():
+            raise ValueError(f"Campo inválido: {field}")
+        return field
+
+    @classmethod
+    def _field_sql(cls, field):
+        if field in ("id", "__name__"):
+            return "id"
+        return f"json_extract(data, '$.{cls._field_name(field)}')"
+
+    @staticmethod
+    def _to_dict(row, fields=None):
+        data = json.loads(row["data"])
+        if fields:
+            data = {key: data[key] for key in fields if key in data}
+        data["id"] = row["id"]
+        return data
+
+    def query(
+        self,
+        collection,
+        filters=(),
+        order_by=None,
+        start_after=None,
+        limit=None,
+        fields=None,
+        descending=False,
+    ):
+        sql = ["SELECT id, data FROM documents WHERE collection = ?"]
+        params = [collection]
+        for field, op, value in filters:
+            if op not in OPERATORS:
+                raise ValueError(f"Operador no soportado: {op}")
+            if op == "array_contains":
+                sql.append(
+                    "AND EXISTS (SELECT 1 FROM json_each(data, ?) WHERE value = ?)"
+                )
+                params.extend([f"$.{self._field_name(field)}", value])
+            else:
+                sql.append(f"AND {self._field_sql(field)} {'=' if op == '==' else op} ?")
+                params.append(value)
+        if order_by:
+            column = self._field_sql(order_by)
+            # Igual que Firestore, los documentos sin el campo no aparecen
+            sql.append(f"AND {column} IS NOT NULL")
+            after = "<" if descending else ">"
+            if start_after:
+                value, doc_id = start_after
+                sql.append(f"AND ({column} {after} ? OR ({column} = ? AND id {after} ?))")
+                params.extend([value, value, doc_id])
+            order = " DESC" if descending else ""
+            sql.append(f"ORDER BY {column}{order}, id{order}")
+        else:
+            sql.append("ORDER BY id")
+        if limit:
+            sql.append("LIMIT ?")
+            params.append(limit)
+
+        for row in self.conn.execute(" ".join(sql), params):
+            yield self._to_dict(row, fields)
+
+    def get(self, collection, doc_id):
+        row = self.conn.execute(
+            "SELECT id, data FROM documents WHERE collection = ? AND id = ?",
+            (collection, doc_id),
+        ).fetchone()
+        return self._to_dict(row) if row else None
+
+    def get_many(self, keys):
+        by_collection = {}
+        for col, doc_id in keys:
+            by_collection.setdefault(col, []).append(doc_id)
+
+        result = {}
+        for col, ids in by_collection.items():
+            placeholders = ", ".join("?" * len(ids))
+            rows = self.conn.execute(
+                f"SELECT id, data FROM documents WHERE collection = ? AND id IN ({placeholders})",
+                [col, *ids],
+            )
+            for row in rows:
+                result[(col, row["id"])] = self._to_dict(row)
+        return result
+
+    def add(self, collection, data):
+        doc_id = uuid.uuid4().hex[:20]
+        with self.conn as conn:
+            conn.execute(
+                "INSERT INTO documents (collection, id, data) VALUES (?, ?, ?)",
+                (collection, doc_id, json.dumps(data)),
+            )
+        return doc_id
+
+    def create(self, collection, doc_id, data):
+        with self.conn as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO documents (collection, id, data) VALUES (?, ?, ?)",
+                (collection, doc_id, json.dumps(data)),
+            )
+        return cursor.rowcount == 1
+
+    def update(self, collection, doc_id, data):
+        with self._write() as conn:
+            self._apply(conn, "update", collection, doc_id, data)
+
+    def delete(self, collection, doc_id):
+        with self.conn as conn:
+            conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND id = ?",
+                (collection, doc_id),
+            )
+
+    def increment(self, collection, doc_id, amounts, extra=None):
+        with self._write() as conn:
+            self._apply(conn, "increment", collection, doc_id, amounts, extra)
+
+    def batch_write(self, operations):
+        ids = []
+        for i in range(0, len(operations), BATCH_LIMIT):
+            with self._write() as conn:
+                for kind, collection, doc_id, data in operations[i : i + BATCH_LIMIT]:
+                    doc_id = doc_id or uuid.uuid4().hex[:20]
+                    self._apply(conn, kind, collection, doc_id, data)
+                    ids.append(doc_id)
+        return ids
+
+    @staticmethod
+    def _apply(conn, kind, collection, doc_id, data, extra=None):
+        """Aplica una escritura dentro de una transacción abierta."""
+        if kind == "delete":
+            conn.execute(
+                "DELETE FROM documents WHERE collection = ? AND id = ?",
+                (collection, doc_id),
+            )
+            return
+
+        row = conn.execute(
+            "SELECT data FROM documents WHERE collection = ? AND id = ?",
+            (collection, doc_id),
+        ).fetchone()
+        current = json.loads(row["data"]) if row else None
+
+        if kind == "set":
+            new = dict(data)
+        elif kind == "merge":
+            new = {**(current or {}), **data}
+        elif kind == "update":
+            if current is None:
+                raise KeyError(f"{collection}/{doc_id} no existe")
+            new = {**current, **data}
+        elif kind == "increment":
+            new = dict(current or {})
+            for field, amount in data.items():
+                new[field] = new.get(field, 0) + amount
+            new.update(extra or {})
+        elif kind == "max":
+            new = dict(current or {})
+            for field, value in data.items():
+                if new.get(field) is None or value > new[field]:
+                    new[field] = value
+        else:
+            raise ValueError(f"Operación desconocida: {kind}")
+
+        conn.execute(
+            "INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)",
+            (collection, doc_id, json.dumps(new)),
+        )
+
+
+BACKENDS = {
+    "firestore": FirestoreBackend,
+    "sqlite": SQLiteBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+# Cuántas veces se reemplazó el backend, y qué hacer cuando pasa (las cachés
+# en memoria de otros módulos son de los datos del backend anterior)
+_backend_generation = 0
+_reset_callbacks = []
+
+
+def get_backend():
+    """Devuelve el backend compartido del proceso, creándolo la primera vez."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.getenv("STORAGE_BACKEND", "firestore").lower()
+                if name not in BACKENDS:
+                    raise ValueError(f"STORAGE_BACKEND desconocido: {name}")
+                _backend = BACKENDS[name]()
+    return _backend
+
+
+def set_backend(backend):
+    """Reemplaza el backend del proceso (por ejemplo, uno SQLite de prueba)."""
+    global _backend, _backend_generation
+    with _backend_lock:
+        _backend = backend
+        _backend_generation += 1
+    for callback in _reset_callbacks:
+        callback()
+
+
+def backend_generation():
+    """Número que cambia con cada set_backend (para ETags y claves de caché)."""
+    return _backend_generation
+
+
+def on_backend_reset(callback):
+    """Llama a `callback()` cada vez que set_backend reemplaza el backend."""
+    _reset_callbacks.append(callback)